@@ -1,28 +1,78 @@
+import asyncio
+import hashlib
+import hmac
 import io
 import logging
 import zipfile
-from typing import List, Optional
+from typing import List, Literal, Optional, Dict, Any, Tuple
 
+import httpx
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Query, Path, Request, Body, Header
 from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from app.db.database import get_db, get_client_ip
+from app.config import settings
+from app.db.database import get_db, get_read_db, get_async_read_db, get_client_ip
 from app.schemas.sticker import StickerResponse, StickerUpdate, StickerPagination, UploadResponse, \
     StickerDescriptionUpdate, StickerTagUpdate, StickerTagsUpdate, StickerBatchDelete
+from app.services.doro_classifier import doro_classifier
 from app.services.sticker_service import sticker_service
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+# 上传文件分块读取的大小
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# 批量下载时同时进行的图片请求数
+DOWNLOAD_CONCURRENCY = 16
+# ZIP输出的写缓冲大小
+ZIP_WRITE_BUFFER_SIZE = 64 * 1024
+
+# 表情包列表的批量校验器，一次调用校验整个列表
+_sticker_list_adapter = TypeAdapter(List[StickerResponse])
+
 
 async def verify_secret_key(secret_key: str = Header(...)):
-    """验证密钥"""
-    from app.config import settings
-    if secret_key != settings.SECRET_KEY:
+    """验证密钥，使用恒定时间比较避免通过响应时间推测密钥内容；未配置密钥时一律拒绝"""
+    if not settings.SECRET_KEY or not hmac.compare_digest(
+            secret_key.encode("utf-8"), settings.SECRET_KEY.encode("utf-8")
+    ):
         raise HTTPException(status_code=401, detail="无效的密钥")
 
 
+async def read_upload_file(file: UploadFile, hasher=None) -> bytes:
+    """
+    读取上传文件，超过大小上限时立即中止，不再读取剩余内容
+
+    multipart请求体在进入接口前已完整接收并缓存，已知文件大小时先按大小校验，
+    再一次性读入，只分配一份内存；大小未知时分块读取。
+    传入hasher(如hashlib.md5())时同时计算摘要
+    """
+    if file.size is not None:
+        if file.size > settings.MAX_UPLOAD_SIZE:
+            raise HTTPException(status_code=413, detail="文件过大")
+        contents = await file.read()
+        if len(contents) > settings.MAX_UPLOAD_SIZE:
+            raise HTTPException(status_code=413, detail="文件过大")
+        if hasher is not None:
+            hasher.update(contents)
+    else:
+        buffer = bytearray()
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            if hasher is not None:
+                hasher.update(chunk)
+            buffer.extend(chunk)
+            if len(buffer) > settings.MAX_UPLOAD_SIZE:
+                raise HTTPException(status_code=413, detail="文件过大")
+        contents = bytes(buffer)
+
+    if not contents:
+        raise HTTPException(status_code=400, detail="文件内容为空")
+    return contents
+
+
 @router.post("/upload", response_model=UploadResponse)
 async def upload_sticker(request: Request, file: UploadFile = File(...), db: Session = Depends(get_db)):
     """上传表情包"""
@@ -31,78 +81,86 @@ async def upload_sticker(request: Request, file: UploadFile = File(...), db: Ses
         raise HTTPException(status_code=400, detail="只能上传图片文件")
 
     try:
-        # 读取文件内容
-        contents = await file.read()
-        if not contents:
-            raise HTTPException(status_code=400, detail="文件内容为空")
+        # 读取文件内容，同时计算MD5
+        hasher = hashlib.md5()
+        contents = await read_upload_file(file, hasher)
 
         # 获取客户端信息
         ip_address = get_client_ip(request)
         user_agent = request.headers.get("User-Agent")
 
         # 调用服务层处理上传
-        result = sticker_service.create_sticker(db, contents, ip_address, user_agent)
+        result = await sticker_service.create_sticker(db, contents, ip_address, user_agent, hasher.hexdigest())
 
         if not result["success"]:
             raise HTTPException(status_code=400, detail=result["message"])
 
         return result
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"处理文件 {file.filename} 时发生错误: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"处理文件时发生错误: {str(e)}")
 
 
 @router.get("/", response_model=StickerPagination)
-def get_stickers(
+async def get_stickers(
         request: Request,
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_async_read_db),
         page: int = Query(1, ge=1, description="页码"),
         size: int = Query(20, ge=1, le=100, description="每页数量"),
         sort_by: str = Query("created_at", description="排序字段"),
         sort_order: str = Query("desc", description="排序方式"),
         search: Optional[str] = Query(None, description="搜索关键词"),
-        tags: Optional[List[str]] = Query(None, description="标签过滤")
+        tags: Optional[List[str]] = Query(None, description="标签过滤"),
+        after: Optional[str] = Query(None, description="分页游标，传入上一页返回的next_cursor，传入时忽略page")
 ):
     """获取表情包列表"""
     skip = (page - 1) * size
     ip_address = get_client_ip(request)
 
-    stickers, total = sticker_service.get_stickers_with_user_actions(
-        db=db,
-        ip_address=ip_address,
-        skip=skip,
-        limit=size,
-        sort_by=sort_by,
-        sort_order=sort_order,
-        search_query=search,
-        tags=tags
-    )
-
-    # 计算总页数
-    pages = (total + size - 1) // size
+    try:
+        stickers, total, next_cursor = await sticker_service.get_stickers_with_user_actions(
+            db=db,
+            ip_address=ip_address,
+            skip=skip,
+            limit=size,
+            sort_by=sort_by,
+            sort_order=sort_order,
+            search_query=search,
+            tags=tags,
+            after=after
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # 计算总页数，过滤查询不返回总数
+    pages = (total + size - 1) // size if total is not None else None
 
     return StickerPagination(
         total=total,
-        items=stickers,
+        items=_sticker_list_adapter.validate_python(stickers),
         page=page,
         size=size,
-        pages=pages
+        pages=pages,
+        has_more=next_cursor is not None,
+        next_cursor=next_cursor
     )
 
 
 @router.get("/random/", response_model=List[StickerResponse])
 def get_random_stickers(
         count: int = Query(1, ge=1, le=10, description="随机表情包数量"),
-        db: Session = Depends(get_db)
+        db: Session = Depends(get_read_db)
 ):
     """获取随机表情包"""
     stickers = sticker_service.get_random_stickers(db, count)
-    return [StickerResponse.from_orm(s) for s in stickers]
+    return _sticker_list_adapter.validate_python(stickers)
 
 
 @router.get("/{sticker_id}")
-def get_sticker(sticker_id: str = Path(..., description="表情包ID"), db: Session = Depends(get_db)):
+def get_sticker(sticker_id: str = Path(..., description="表情包ID"), db: Session = Depends(get_read_db)):
     """获取单个表情包"""
     sticker = sticker_service.get_sticker(db, sticker_id)
     if not sticker:
@@ -158,7 +216,7 @@ def dislike_sticker(
 @router.get("/tags/popular/", response_model=List[dict])
 def get_popular_tags(
         limit: int = Query(20, ge=1, le=100, description="返回标签数量"),
-        db: Session = Depends(get_db)
+        db: Session = Depends(get_read_db)
 ):
     """获取热门标签"""
     return sticker_service.get_popular_tags(db, limit)
@@ -190,10 +248,84 @@ def update_tags_to_sticker(
     return result
 
 
+class _ZipStreamSink(io.RawIOBase):
+    """ZipFile的只写输出端，暂存已写入的数据，供流式响应分段取走"""
+
+    def __init__(self):
+        super().__init__()
+        self._buffer = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._buffer.extend(b)
+        return len(b)
+
+    def drain(self) -> bytes:
+        """取走并清空已写入的数据"""
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+async def _fetch_sticker_image(
+        client: httpx.AsyncClient,
+        semaphore: asyncio.Semaphore,
+        sticker: Dict[str, Any]
+) -> Optional[Tuple[str, bytes]]:
+    """下载单个表情包图片，返回(文件名, 图片内容)，失败时返回None"""
+    async with semaphore:
+        try:
+            response = await client.get(sticker["url"])
+        except httpx.HTTPError as e:
+            logger.warning(f"下载表情包 {sticker['id']} 时出错: {str(e)}")
+            return None
+
+    if response.status_code != 200:
+        logger.warning(f"下载表情包 {sticker['id']} 失败: {response.status_code}")
+        return None
+
+    # 创建一个有意义的文件名
+    filename = f"{sticker['id'][:4]}_{sticker['description'][:10]}_{sticker['md5'][-6:]}.png"
+    return filename, response.content
+
+
+async def _stream_stickers_zip(client: httpx.AsyncClient, stickers: List[Dict[str, Any]]):
+    """边下载边压缩，每写入一个文件就把生成的ZIP数据发送给客户端"""
+    # 输出端不可seek，ZipFile会自动改用数据描述符写入，无需回填文件头
+    sink = _ZipStreamSink()
+    # ZipFile会产生大量小块写入(文件头、数据描述符等)，用64KiB缓冲合并后再交给输出端
+    writer = io.BufferedWriter(sink, buffer_size=ZIP_WRITE_BUFFER_SIZE)
+    # 并发下载表情包图片，信号量限制同时进行的请求数
+    semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+    tasks = [asyncio.create_task(_fetch_sticker_image(client, semaphore, sticker)) for sticker in stickers]
+    try:
+        # 图片本身已是压缩格式，deflate几乎无法再减小体积，直接存储即可
+        with zipfile.ZipFile(writer, "w", zipfile.ZIP_STORED) as zip_file:
+            # 按完成顺序写入ZIP，CRC计算放到线程池中执行，避免阻塞事件循环
+            for future in asyncio.as_completed(tasks):
+                item = await future
+                if item:
+                    await asyncio.to_thread(zip_file.writestr, *item)
+                    # 缓冲区未满时没有数据输出，等凑满64KiB再发送
+                    chunk = sink.drain()
+                    if chunk:
+                        yield chunk
+        # 写入中央目录并刷出缓冲区剩余数据
+        writer.flush()
+        yield sink.drain()
+    finally:
+        # 客户端中途断开时取消未完成的下载
+        for task in tasks:
+            task.cancel()
+
+
 @router.post("/download/batch/")
-def download_batch_stickers(
-        sticker_ids: List[int],
-        db: Session = Depends(get_db)
+async def download_batch_stickers(
+        request: Request,
+        sticker_ids: List[str],
+        db: Session = Depends(get_read_db)
 ):
     """批量下载表情包"""
     if not sticker_ids:
@@ -203,33 +335,15 @@ def download_batch_stickers(
         raise HTTPException(status_code=400, detail="一次最多下载100个表情包")
 
     # 获取表情包信息
-    stickers = sticker_service.batch_download_stickers(db, sticker_ids)
+    stickers = await asyncio.to_thread(sticker_service.batch_download_stickers, db, sticker_ids)
 
     if not stickers:
         raise HTTPException(status_code=404, detail="没有找到有效的表情包")
 
-    # 创建内存中的ZIP文件
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-        for sticker in stickers:
-            # 下载表情包图片
-            try:
-                import requests
-                response = requests.get(sticker.url)
-                if response.status_code == 200:
-                    # 创建一个有意义的文件名
-                    filename = f"{sticker.id[:4]}_{sticker.description[:10]}_{sticker.md5[-6:]}.png"
-                    zip_file.writestr(filename, response.content)
-            except Exception as e:
-                print(f"下载表情包 {sticker.id} 时出错: {str(e)}")
-                continue
-
-    # 设置ZIP文件指针到开头
-    zip_buffer.seek(0)
-
     # 返回流式响应
     return StreamingResponse(
-        zip_buffer,
+        # 复用应用级的HTTP客户端，图床连接在请求之间保持长连接
+        _stream_stickers_zip(request.app.state.http_client, stickers),
         media_type="application/zip",
         headers={"Content-Disposition": f"attachment; filename=doro_stickers.zip"}
     )
@@ -259,9 +373,13 @@ def update_sticker_description(
     "/{identifier}",
     dependencies=[Depends(verify_secret_key)],
     summary="删除表情包")
-def delete_sticker(identifier: str = Path(..., description="表情包ID或MD5"), db: Session = Depends(get_db)):
+def delete_sticker(
+        identifier: str = Path(..., description="表情包ID或MD5"),
+        identifier_type: Optional[Literal["id", "md5"]] = Query(None, description="标识类型，不传时按长度判断"),
+        db: Session = Depends(get_db)
+):
     """删除表情包"""
-    result = sticker_service.delete_sticker(db, identifier)
+    result = sticker_service.delete_sticker(db, identifier, identifier_type)
     if not result["success"]:
         raise HTTPException(status_code=404, detail=result["message"])
     return result
@@ -308,13 +426,10 @@ async def predict_doro(
 
     try:
         # 读取文件内容
-        contents = await file.read()
-        if not contents:
-            raise HTTPException(status_code=400, detail="文件内容为空")
+        contents = await read_upload_file(file)
 
-        # 执行预测
-        from app.services.doro_classifier import doro_classifier
-        prediction = doro_classifier.predict(contents)
+        # 执行预测，并发请求由分类器合并为批量推理
+        prediction = await doro_classifier.predict_async(contents)
 
         return {
             "is_doro": bool(prediction["is_doro"]),
@@ -323,6 +438,8 @@ async def predict_doro(
                 str(k): float(v) for k, v in prediction.get("probabilities", {}).items()
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"处理文件 {file.filename} 时发生错误: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"处理文件时发生错误: {str(e)}")
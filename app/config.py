@@ -1,54 +1,82 @@
 import os
-from typing import List
+from typing import Annotated, List, Optional
 
-from dotenv import load_dotenv
-from pydantic_settings import BaseSettings
-
-# 加载环境变量
-load_dotenv()
+from pydantic import field_validator
+from pydantic_settings import BaseSettings, NoDecode, SettingsConfigDict
 
 
 class Settings(BaseSettings):
+    # 环境变量和.env文件由pydantic-settings在实例化时统一读取并校验
+    model_config = SettingsConfigDict(env_file=".env", case_sensitive=True, extra="ignore")
+
     # 基本配置
     PROJECT_NAME: str = "DORO表情包收集系统"
     PROJECT_VERSION: str = "1.0.0"
-    DEBUG: bool = os.getenv("DEBUG", "False").lower() in ("true", "1", "t")
-    SECRET_KEY: str = os.getenv("SECRET_KEY")
+    DEBUG: bool = False
+    SECRET_KEY: Optional[str] = None
 
     # 服务器配置
-    HOST: str = os.getenv("HOST", "0.0.0.0")
-    PORT: int = int(os.getenv("PORT", "8000"))
-    WORKERS: int = int(os.getenv("WORKERS", "1"))
+    HOST: str = "0.0.0.0"
+    PORT: int = 8000
+    # 默认按CPU核数的一半启动多个进程，避免模型推理等CPU密集任务被单进程串行化
+    # 各进程之间的状态都保存在数据库中，多进程部署无需额外处理
+    WORKERS: int = max(2, (os.cpu_count() or 2) // 2)
 
     # 数据库配置
-    DATABASE_URL: str = os.getenv("DATABASE_URL", "")
-    DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", "5"))
-    DB_MAX_OVERFLOW: int = int(os.getenv("DB_MAX_OVERFLOW", "10"))
-    DB_POOL_TIMEOUT: int = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+    DATABASE_URL: str = ""
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: int = 30
+    AUTO_CREATE_TABLES: bool = True  # 启动时自动建表并补齐新增的列和索引
 
     # 模型配置
-    MODEL_PATH: str = os.getenv("MODEL_PATH", "model/model.onnx")
+    MODEL_PATH: str = "model/model.onnx"
+    # 量化后的模型(由scripts/quantize_model.py生成)，文件存在时CPU推理使用INT8、CUDA推理使用FP16
+    MODEL_PATH_INT8: str = "model/model.int8.onnx"
+    MODEL_PATH_FP16: str = "model/model.fp16.onnx"
+    # TensorRT配置，仅在onnxruntime支持TensorrtExecutionProvider时生效
+    TRT_CACHE_DIR: str = "model/trt_cache"
+    TRT_FP16: bool = True
+    DORO_BATCH_SIZE: int = 32  # 动态批处理的最大批大小，设为1时关闭批处理
+    DORO_BATCH_WAIT_MS: float = 10  # 凑批的最长等待时间(毫秒)
+    DORO_CACHE_TTL: int = 86400  # DORO分类结果按图片MD5缓存的时间(秒)
 
     # OpenAI API配置
-    OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY", "")
-    OPENAI_BASE_URL: str = os.getenv("OPENAI_BASE_URL", "https://api.siliconflow.cn/v1")
-    OPENAI_TIMEOUT: int = int(os.getenv("OPENAI_TIMEOUT", "30"))
+    OPENAI_API_KEY: str = ""
+    OPENAI_BASE_URL: str = "https://api.siliconflow.cn/v1"
+    OPENAI_TIMEOUT: int = 30
+    OCR_CACHE_TTL: int = 86400  # AI描述结果按图片MD5缓存的时间(秒)
+
+    # 缓存配置，未配置REDIS_URL时使用进程内缓存
+    REDIS_URL: Optional[str] = None
 
     # 图床API配置
-    PICB_API_KEY: str = os.getenv("PICB_API_KEY", "")
-    PICB_ALBUM_ID: str = os.getenv("PICB_ALBUM_ID", "")
-    PICB_UPLOAD_URL: str = os.getenv("PICB_UPLOAD_URL", "https://www.picb.cc/api/1/upload")
-    PICB_TIMEOUT: int = int(os.getenv("PICB_TIMEOUT", "30"))
+    PICB_API_KEY: str = ""
+    PICB_ALBUM_ID: str = ""
+    PICB_UPLOAD_URL: str = "https://www.picb.cc/api/1/upload"
+    PICB_TIMEOUT: int = 30
+
+    # 出站HTTP请求配置
+    HTTP_TIMEOUT: int = 10
 
-    # CORS设置
-    CORS_ORIGINS: List[str] = os.getenv("CORS_ORIGINS", "*").split(",")
+    # CORS设置，环境变量中以逗号分隔
+    CORS_ORIGINS: Annotated[List[str], NoDecode] = ["*"]
 
     # 其他设置
-    TEMP_DIR: str = os.getenv("TEMP_DIR", "temp")
-    PIC_DIR: str = os.getenv("PIC_DIR", "")
+    TEMP_DIR: str = "temp"
+    PIC_DIR: str = ""
+    MAX_UPLOAD_SIZE: int = 10 * 1024 * 1024  # 上传文件大小上限(字节)
+    # 上传时按感知哈希查找重新编码、缩放过的相同图片，命中时直接按已存在处理；
+    # 同一底图配不同文字的表情包感知哈希可能相同，因此默认关闭
+    PHASH_DEDUP: bool = False
 
-    class Config:
-        env_file = ".env"
+    @field_validator("CORS_ORIGINS", mode="before")
+    @classmethod
+    def split_cors_origins(cls, value):
+        """将逗号分隔的字符串拆分为列表"""
+        if isinstance(value, str):
+            return value.split(",")
+        return value
 
 
 settings = Settings()
@@ -2,8 +2,9 @@ import logging
 from contextlib import contextmanager
 
 from fastapi import Request
-from sqlalchemy import create_engine, QueuePool, event
+from sqlalchemy import create_engine, QueuePool, event, make_url, text
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 
@@ -25,6 +26,43 @@ engine = create_engine(
 # 创建会话工厂
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# 只读会话工厂，供只查询不修改的接口使用：连接处于自动提交模式，
+# 不再额外发送BEGIN和归还连接时的ROLLBACK，每个请求少两次往返；提交后也不使对象过期
+ReadSessionLocal = sessionmaker(
+    bind=engine.execution_options(isolation_level="AUTOCOMMIT"),
+    autoflush=False,
+    expire_on_commit=False
+)
+
+
+def _async_database_url(url: str):
+    """将数据库URL转换为异步驱动，psycopg(v3)同时支持同步和异步，无需额外安装驱动"""
+    db_url = make_url(url)
+    if db_url.drivername in ("postgresql", "postgresql+psycopg2"):
+        db_url = db_url.set(drivername="postgresql+psycopg")
+    return db_url
+
+
+# 异步数据库引擎，供读多写少的列表等接口使用，不占用线程池
+async_engine = create_async_engine(
+    _async_database_url(str(settings.DATABASE_URL)),
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_timeout=settings.DB_POOL_TIMEOUT,
+    pool_pre_ping=True,
+    pool_recycle=3600
+)
+
+# 异步会话工厂，提交后不使对象过期，避免在await之外触发隐式加载
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+# 异步只读会话工厂，同样使用自动提交模式的连接
+AsyncReadSessionLocal = async_sessionmaker(
+    async_engine.execution_options(isolation_level="AUTOCOMMIT"),
+    autoflush=False,
+    expire_on_commit=False
+)
+
 # 创建基类
 Base = declarative_base()
 
@@ -45,6 +83,49 @@ def checkin(dbapi_connection, connection_record):
     logger.debug("数据库连接已被归还")
 
 
+# init_db使用的事务级咨询锁ID，多个worker同时启动时依次执行建表和补齐结构
+_INIT_DB_LOCK_ID = 0x646F726F
+
+
+def init_db():
+    """
+    创建数据表，并为已存在的表补齐模型中新增的列和索引
+
+    每个worker启动时都会调用，整个过程在一个事务中持有咨询锁，同一时间只有一个进程执行；
+    首次启动时后到的进程等锁释放后看到已建好的表，不会因表或索引已存在而失败
+    """
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": _INIT_DB_LOCK_ID})
+        Base.metadata.create_all(bind=conn)
+        # 已存在的stickers表补上ext列，并从URL回填文件后缀
+        conn.execute(text("ALTER TABLE stickers ADD COLUMN IF NOT EXISTS ext VARCHAR(8)"))
+        conn.execute(text(
+            "UPDATE stickers SET ext = substring(url from '\\.([^./?#]{1,8})(?:[?#].*)?$') "
+            "WHERE ext IS NULL"
+        ))
+        # 感知哈希需要原图计算，已有记录不回填，只对之后上传的表情包生效
+        conn.execute(text("ALTER TABLE stickers ADD COLUMN IF NOT EXISTS phash BIGINT"))
+        # 旧的(ip_address, sticker_id)唯一索引与(sticker_id, ip_address)的覆盖索引重复，每次投票要多维护一份
+        conn.execute(text("DROP INDEX IF EXISTS idx_user_action"))
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
+
+        # 描述的三元组GIN索引，ILIKE '%关键词%'的模糊搜索可以走索引，不再全表扫描。
+        # 描述多为中文短句，按空格分词的全文检索匹配不到句中的子串，因此保留ILIKE的语义；
+        # 索引依赖pg_trgm扩展，数据库未安装该扩展时跳过(在保存点中执行，失败不影响上面的操作)，
+        # 搜索退回到顺序扫描
+        try:
+            with conn.begin_nested():
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                conn.execute(text(
+                    "CREATE INDEX IF NOT EXISTS idx_sticker_description_trgm "
+                    "ON stickers USING gin (description gin_trgm_ops)"
+                ))
+        except SQLAlchemyError as e:
+            logger.warning(f"无法创建描述的三元组索引，模糊搜索将使用顺序扫描: {str(e)}")
+
+
 # 依赖项，用于获取数据库会话
 def get_db():
     db = SessionLocal()
@@ -54,6 +135,27 @@ def get_db():
         db.close()
 
 
+# 依赖项，用于获取只读数据库会话，会话中不能有写操作
+def get_read_db():
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+# 依赖项，用于获取异步数据库会话
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+# 依赖项，用于获取异步只读数据库会话，会话中不能有写操作
+async def get_async_read_db():
+    async with AsyncReadSessionLocal() as db:
+        yield db
+
+
 # 事务上下文管理器
 @contextmanager
 def transaction_context(db: Session):
@@ -76,24 +178,25 @@ def transaction_context(db: Session):
         raise
 
 
+# 按优先级检查的代理头
+_CLIENT_IP_HEADERS = (
+    "X-Forwarded-For",
+    "X-Real-IP",
+    "CF-Connecting-IP",  # Cloudflare
+    "True-Client-IP"
+)
+
+
 # 获取用户IP的辅助函数
 def get_client_ip(request: Request) -> str:
     """获取客户端真实IP地址，处理多级代理情况"""
-    # 优先从常用代理头获取
-    headers_to_check = [
-        "X-Forwarded-For",
-        "X-Real-IP",
-        "CF-Connecting-IP",  # Cloudflare
-        "True-Client-IP"
-    ]
-
-    for header in headers_to_check:
-        if header in request.headers:
-            value = request.headers[header]
-            # X-Forwarded-For可能包含多个IP，第一个是客户端的真实IP
-            if header == "X-Forwarded-For" and "," in value:
-                return value.split(",")[0].strip()
-            return value.strip()
+    # 优先从常用代理头获取，命中第一个即返回
+    for header in _CLIENT_IP_HEADERS:
+        value = request.headers.get(header)
+        if value:
+            # X-Forwarded-For可能包含多个IP，第一个是客户端的真实IP；
+            # partition在没有逗号时也不会创建列表
+            return value.partition(",")[0].strip()
 
     # 如果没有代理头，使用直接的客户端地址
-    return request.client.host if request.client else "unknown"
\ No newline at end of file
+    return request.client.host if request.client else "unknown"
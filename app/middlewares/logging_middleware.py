@@ -10,24 +10,24 @@ logger = logging.getLogger(__name__)
 
 class LoggingMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
-        request_id = str(uuid4())
+        request_id = uuid4().hex
         request.state.request_id = request_id
 
         # 记录请求开始
-        start_time = time.time()
+        start_time = time.perf_counter_ns()
         path = request.url.path
         method = request.method
 
-        logger.info(f"开始请求 [{request_id}] {method} {path}")
+        logger.info("开始请求 [%s] %s %s", request_id, method, path)
 
         try:
             response = await call_next(request)
 
             # 记录请求结束
-            process_time = time.time() - start_time
+            process_time = (time.perf_counter_ns() - start_time) / 1e6
             status_code = response.status_code
             logger.info(
-                f"完成请求 [{request_id}] {method} {path} - {status_code} - 耗时: {process_time:.3f}s"
+                "完成请求 [%s] %s %s - %d - 耗时: %.3fms", request_id, method, path, status_code, process_time
             )
 
             # 添加请求ID到响应头
@@ -35,8 +35,8 @@ class LoggingMiddleware(BaseHTTPMiddleware):
             return response
 
         except Exception as e:
-            process_time = time.time() - start_time
+            process_time = (time.perf_counter_ns() - start_time) / 1e6
             logger.error(
-                f"请求异常 [{request_id}] {method} {path} - 耗时: {process_time:.3f}s - 错误: {str(e)}"
+                "请求异常 [%s] %s %s - 耗时: %.3fms - 错误: %s", request_id, method, path, process_time, e
             )
             raise
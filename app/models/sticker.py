@@ -1,7 +1,8 @@
 import time
-import uuid
+from operator import attrgetter
 
-from sqlalchemy import Column, String, Integer, Float, BigInteger
+import uuid_utils
+from sqlalchemy import Column, String, Integer, Float, BigInteger, Index
 from sqlalchemy.orm import relationship
 
 from app.db.database import Base
@@ -11,7 +12,8 @@ from app.models.tag import sticker_tags_association_table
 class Sticker(Base):
     __tablename__ = "stickers"
 
-    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = Column(String(36), primary_key=True, default=lambda: str(uuid_utils.uuid7()),
+                comment="UUIDv7，按时间递增，新记录总是追加到主键索引末尾")
     md5 = Column(String(32), unique=True, index=True, nullable=False)
     url = Column(String(255), nullable=False)
     description = Column(String(20), nullable=False)
@@ -25,21 +27,40 @@ class Sticker(Base):
     width = Column(Integer, nullable=True)
     height = Column(Integer, nullable=True)
     file_size = Column(Integer, nullable=True)
+    ext = Column(String(8), nullable=True, comment="图片文件后缀，插入时从图床URL中解析，本地副本名为md5.ext")
+    phash = Column(BigInteger, nullable=True, index=True,
+                   comment="64位感知哈希(按有符号整数保存)，用于识别重新编码、缩放过的相同图片")
 
-    # 将模型实例转换为字典
-    def as_dict(self):
-        return {
-            "id": self.id,
-            "md5": self.md5,
-            "url": self.url,
-            "description": self.description,
-            "created_at": self.created_at,
-            "updated_at": self.updated_at,
-            "likes": self.likes,
-            "dislikes": self.dislikes,
-            "doro_confidence": self.doro_confidence,
-            "tags": [tag.name for tag in self.tags],
-            "width": self.width,
-            "height": self.height,
-            "file_size": self.file_size
-        }
+    # 将模型实例转换为字典，list_only为True时只包含列表接口需要的列
+    def as_dict(self, list_only: bool = False):
+        if list_only:
+            data = dict(zip(_LIST_COLUMN_NAMES, _get_list_columns(self)))
+        else:
+            data = dict(zip(_COLUMN_NAMES, _get_columns(self)))
+        data["tags"] = list(map(_get_name, self.tags))
+        return data
+
+
+# as_dict返回的列，不含文件后缀、感知哈希等只在服务内部使用的列
+_PUBLIC_COLUMNS = (
+    Sticker.id, Sticker.md5, Sticker.url, Sticker.description, Sticker.created_at, Sticker.updated_at,
+    Sticker.likes, Sticker.dislikes, Sticker.doro_confidence,
+    Sticker.width, Sticker.height, Sticker.file_size,
+)
+
+# 预先计算列名和取值器，as_dict无需每次逐列getattr
+_COLUMN_NAMES = tuple(column.key for column in _PUBLIC_COLUMNS)
+_get_columns = attrgetter(*_COLUMN_NAMES)
+_get_name = attrgetter("name")
+
+# 列表接口返回的列，列表查询配合load_only只加载这些列，更新时间、文件后缀等不再读取
+STICKER_LIST_COLUMNS = (
+    Sticker.id, Sticker.md5, Sticker.url, Sticker.description, Sticker.created_at,
+    Sticker.likes, Sticker.dislikes, Sticker.doro_confidence,
+    Sticker.width, Sticker.height, Sticker.file_size,
+)
+_LIST_COLUMN_NAMES = tuple(column.key for column in STICKER_LIST_COLUMNS)
+_get_list_columns = attrgetter(*_LIST_COLUMN_NAMES)
+
+# 支持按(created_at, id)的键集分页，避免深分页时的OFFSET扫描
+Index("idx_sticker_created_at_id", Sticker.created_at.desc(), Sticker.id.desc())
@@ -1,7 +1,7 @@
 import time
 
 from sqlalchemy import String, BigInteger
-from sqlalchemy import Table, Column, ForeignKey, Integer
+from sqlalchemy import Table, Column, ForeignKey, Integer, Index
 
 from app.db.database import Base
 
@@ -19,7 +19,9 @@ sticker_tags_association_table = Table(
         Integer,
         ForeignKey('tags.id', ondelete="CASCADE"),
         primary_key=True
-    )
+    ),
+    # 主键为(sticker_id, tag_id)，按标签筛选表情包需要反向的复合索引
+    Index('idx_sticker_tags_tag_sticker', 'tag_id', 'sticker_id')
 )
 
 
@@ -30,5 +32,11 @@ class Tag(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(10), unique=True, index=True, nullable=False)
     usage_count = Column(Integer, default=0, nullable=False)
-    created_at = Column(BigInteger, default=(time.time()), nullable=False)
-    updated_at = Column(BigInteger, default=(time.time()), onupdate=(time.time()), nullable=False)
+    created_at = Column(BigInteger, default=lambda: int(time.time()), nullable=False)
+    updated_at = Column(BigInteger, default=lambda: int(time.time()),
+                        onupdate=lambda: int(time.time()), nullable=False)
+
+    # 加速按使用次数排序的热门标签查询
+    __table_args__ = (
+        Index('idx_tag_usage_count', usage_count.desc()),
+    )
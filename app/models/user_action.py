@@ -20,7 +20,14 @@ class UserAction(Base):
     )
     action = Column(action_type, nullable=False)  # 'like' or 'dislike'
 
-    # 创建复合索引以加速查询
+    # 按(表情包, IP)查询操作状态的覆盖索引，action直接从索引读取，无需回表；
+    # 唯一约束保证同一IP对同一表情包最多一条操作记录
     __table_args__ = (
-        Index('idx_user_action', 'ip_address', 'sticker_id', unique=True),
+        Index(
+            'idx_user_action_sticker_ip',
+            'sticker_id',
+            'ip_address',
+            unique=True,
+            postgresql_include=['action']
+        ),
     )
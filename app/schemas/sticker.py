@@ -31,17 +31,20 @@ class StickerResponse(StickerBase):
     created_at: datetime
     likes: int = 0
     dislikes: int = 0
+    user_action: Optional[str] = None  # 当前用户的操作(like/dislike)，仅列表接口返回
 
     class Config:
         from_attributes = True
 
 
 class StickerPagination(BaseModel):
-    total: int
+    total: Optional[int] = None
     items: List[StickerResponse]
     page: int
     size: int
-    pages: int
+    pages: Optional[int] = None
+    has_more: bool = False
+    next_cursor: Optional[str] = None
 
 
 class UploadResponse(BaseModel):
@@ -0,0 +1,78 @@
+import logging
+import threading
+from typing import Any, Optional
+
+import orjson
+from cachetools import TLRUCache
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class CacheService:
+    """
+    键值缓存，值以JSON形式保存
+
+    配置了REDIS_URL时使用Redis，多个worker进程共享缓存；否则退回到进程内的TLRU缓存
+    """
+
+    def __init__(self, redis_url: Optional[str] = None, maxsize: int = 10000):
+        self.redis = None
+        self._redis_sync = None
+        if redis_url:
+            # redis为可选依赖，仅在配置了REDIS_URL时导入
+            import redis
+            import redis.asyncio
+            self.redis = redis.asyncio.from_url(redis_url)
+            # 同步客户端，供事务提交回调等在线程池中执行、不能await的代码使用
+            self._redis_sync = redis.Redis.from_url(redis_url)
+
+        # 本地缓存中每项保存为(过期秒数, 值)，按各自的过期时间淘汰
+        self._local = TLRUCache(maxsize=maxsize, ttu=lambda _key, item, now: now + item[0])
+        self._lock = threading.Lock()
+
+    async def get(self, key: str) -> Optional[Any]:
+        """读取缓存，不存在或读取失败时返回None"""
+        if self.redis is not None:
+            try:
+                raw = await self.redis.get(key)
+                return orjson.loads(raw) if raw is not None else None
+            except Exception as e:
+                logger.warning(f"读取缓存失败: {key} - {str(e)}")
+                return None
+
+        with self._lock:
+            item = self._local.get(key)
+        return item[1] if item is not None else None
+
+    async def set(self, key: str, value: Any, ttl: int):
+        """写入缓存，ttl为过期时间(秒)，写入失败只记录日志"""
+        if self.redis is not None:
+            try:
+                await self.redis.set(key, orjson.dumps(value), ex=ttl)
+            except Exception as e:
+                logger.warning(f"写入缓存失败: {key} - {str(e)}")
+            return
+
+        with self._lock:
+            self._local[key] = (ttl, value)
+
+    def incr_sync(self, key: str):
+        """同步地将Redis中的计数加1，未配置Redis时不做任何事，失败只记录日志"""
+        if self._redis_sync is None:
+            return
+        try:
+            self._redis_sync.incr(key)
+        except Exception as e:
+            logger.warning(f"递增计数失败: {key} - {str(e)}")
+
+    async def close(self):
+        """关闭Redis连接"""
+        if self.redis is not None:
+            await self.redis.aclose()
+            self._redis_sync.close()
+
+
+# 创建单例实例
+cache_service = CacheService(redis_url=settings.REDIS_URL)
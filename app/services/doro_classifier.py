@@ -1,9 +1,13 @@
+import asyncio
 import io
 import logging
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
 
+import cv2
 import numpy as np
 import onnxruntime as ort
 from PIL import Image
@@ -12,11 +16,33 @@ from app.config import settings
 
 logger = logging.getLogger(__name__)
 
+# 每个worker进程分到的CPU核数：多个worker各自加载模型，推理和预处理线程数按核数平分，避免进程之间争抢CPU
+_CPUS_PER_WORKER = max(1, (os.cpu_count() or 4) // max(1, settings.WORKERS))
+
 
 class DoroClassifier:
-    def __init__(self, model_path: Path = settings.MODEL_PATH):
+    # 归一化参数(与训练时相同的均值和标准差，RGB顺序)，预先换算到0~255的像素值上：
+    # (x / 255 - mean) / std == (x - mean * 255) * (1 / (std * 255))
+    MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32).reshape((3, 1, 1)) * 255.0
+    SCALE = 1.0 / (np.array([0.229, 0.224, 0.225], dtype=np.float32).reshape((3, 1, 1)) * 255.0)
+
+    def __init__(
+            self,
+            model_path: Path = settings.MODEL_PATH,
+            max_batch_size: int = settings.DORO_BATCH_SIZE,
+            max_batch_wait_ms: float = settings.DORO_BATCH_WAIT_MS
+    ):
         self.model_path = model_path
         self.input_size = (320, 320)
+        self.max_batch_size = max_batch_size
+        self.max_batch_wait = max_batch_wait_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._batch_task: Optional[asyncio.Task] = None
+        # 批处理任务交替使用的两个输入缓冲区：一个在推理时，另一个可以写入下一批的预处理结果
+        self._batch_buffers: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        # 批处理的预处理线程池，解码和缩放在原生代码中释放GIL，可以多线程并行
+        self._preprocess_pool: Optional[ThreadPoolExecutor] = None
+        self._inference_task: Optional[asyncio.Task] = None
         self._load_model()
 
     def _load_model(self):
@@ -29,20 +55,51 @@ class DoroClassifier:
                 # 配置优化选项
                 sess_options = ort.SessionOptions()
                 sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
-                sess_options.intra_op_num_threads = 4  # 并行线程数
+                # 算子内并行线程数按本进程分到的核数设置；模型为单分支结构，算子间顺序执行即可
+                sess_options.intra_op_num_threads = min(8, _CPUS_PER_WORKER)
+                if settings.WORKERS > 1:
+                    # 多进程时空闲的推理线程不自旋等待，让出CPU给其他worker
+                    sess_options.add_session_config_entry("session.intra_op.allow_spinning", "0")
+                sess_options.inter_op_num_threads = 1
+                sess_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+                # 输入形状固定，开启内存复用模式和内存池，重复推理时无需重新分配
+                sess_options.enable_mem_pattern = True
+                sess_options.enable_cpu_mem_arena = True
+                sess_options.add_session_config_entry("session.disable_prepacking", "0")
 
-                # 使用GPU加速如果可用
-                providers = ['CUDAExecutionProvider', 'CPUExecutionProvider']
+                # 使用GPU加速如果可用(优先TensorRT)，CPU上优先使用oneDNN(支持VNNI的INT8指令)
+                available_providers = ort.get_available_providers()
+                providers = [
+                    provider for provider in (
+                        'TensorrtExecutionProvider', 'CUDAExecutionProvider', 'DnnlExecutionProvider',
+                        'CPUExecutionProvider'
+                    )
+                    if provider in available_providers
+                ]
+                model_path = self._select_model_path(providers)
+                if providers[0] == 'TensorrtExecutionProvider':
+                    providers[0] = ('TensorrtExecutionProvider', self._tensorrt_options(model_path))
 
                 self.session = ort.InferenceSession(
-                    str(self.model_path),
+                    str(model_path),
                     sess_options=sess_options,
                     providers=providers
                 )
 
-                self.input_name = self.session.get_inputs()[0].name
+                # 输出直接分配在执行设备上，推理结束后再统一拷回CPU
+                self.device = "cuda" if self.session.get_providers()[0] in (
+                    "TensorrtExecutionProvider", "CUDAExecutionProvider"
+                ) else "cpu"
+
+                model_input = self.session.get_inputs()[0]
+                self.input_name = model_input.name
                 self.output_name = self.session.get_outputs()[0].name
-                logger.info(f"DORO分类器模型加载成功: {self.model_path}")
+                # 模型导出时固定了batch维度的，只能逐张推理
+                if isinstance(model_input.shape[0], int):
+                    self.max_batch_size = min(self.max_batch_size, model_input.shape[0])
+
+                self._warmup()
+                logger.info(f"DORO分类器模型加载成功: {model_path}")
                 return
 
             except Exception as e:
@@ -52,80 +109,353 @@ class DoroClassifier:
                 else:
                     raise RuntimeError(f"无法加载DORO分类模型: {e}")
 
+    def _warmup(self):
+        """
+        用全零输入预先推理，把图优化、内核选择和TensorRT引擎构建的开销放在启动阶段，
+        按单张和最大批大小各执行一次，覆盖动态批处理会用到的形状范围
+        """
+        start_time = time.time()
+        for batch_size in sorted({1, self.max_batch_size}):
+            self._infer(np.zeros((batch_size, 3, *self.input_size), dtype=np.float32))
+        logger.info(f"DORO分类器预热完成，耗时: {time.time() - start_time:.2f}秒")
+
+    def _select_model_path(self, providers: List[str]) -> str:
+        """根据执行设备选择量化模型：CUDA使用FP16，CPU使用INT8，文件不存在时使用原始模型"""
+        # 显式指定了模型路径时不做替换；TensorRT自行选择精度，直接使用原始FP32模型
+        if str(self.model_path) != settings.MODEL_PATH or 'TensorrtExecutionProvider' in providers:
+            return str(self.model_path)
+        if 'CUDAExecutionProvider' in providers:
+            candidate = settings.MODEL_PATH_FP16
+        else:
+            candidate = settings.MODEL_PATH_INT8
+        if candidate and os.path.exists(candidate):
+            return candidate
+        return str(self.model_path)
+
+    def _tensorrt_options(self, model_path: str) -> Dict[str, Any]:
+        """
+        TensorRT执行器配置：开启FP16和引擎缓存，避免每次启动重新构建引擎；
+        batch维度可变时按动态批处理的范围设置优化配置，只构建一个引擎
+        """
+        os.makedirs(settings.TRT_CACHE_DIR, exist_ok=True)
+        options = {
+            'trt_fp16_enable': settings.TRT_FP16,
+            'trt_engine_cache_enable': True,
+            'trt_engine_cache_path': settings.TRT_CACHE_DIR,
+            'trt_max_workspace_size': 2 << 30,
+        }
+
+        # 创建会话前无法获取输入信息，用CPU会话读取输入名和形状
+        model_input = ort.InferenceSession(model_path, providers=['CPUExecutionProvider']).get_inputs()[0]
+        if not isinstance(model_input.shape[0], int):
+            shape = "x".join(str(dim) for dim in (3, *self.input_size))
+            options['trt_profile_min_shapes'] = f"{model_input.name}:1x{shape}"
+            options['trt_profile_opt_shapes'] = f"{model_input.name}:{self.max_batch_size}x{shape}"
+            options['trt_profile_max_shapes'] = f"{model_input.name}:{self.max_batch_size}x{shape}"
+        return options
+
     def preprocess_image(self, image_bytes: bytes) -> np.ndarray:
         """将图像字节数据预处理为适合模型输入的格式"""
-        # 读取图像
-        image = Image.open(io.BytesIO(image_bytes))
-        image = image.convert('RGB')  # 确保图像是RGB格式
+        img_array = np.empty((1, 3, *self.input_size), dtype=np.float32)
+        self.preprocess_into(image_bytes, img_array[0])
+        return img_array
 
-        # 调整大小
-        image = image.resize(self.input_size)
+    # JPEG缩小解码的倍数及对应的OpenCV标志，从大到小尝试
+    _JPEG_REDUCED_FLAGS = (
+        (8, cv2.IMREAD_REDUCED_COLOR_8),
+        (4, cv2.IMREAD_REDUCED_COLOR_4),
+        (2, cv2.IMREAD_REDUCED_COLOR_2),
+    )
 
-        # 转换为numpy数组
-        img_array = np.array(image).astype(np.float32)
+    def _imread_flags(self, image_bytes: bytes) -> int:
+        """
+        选择解码标志：JPEG在缩小后仍不小于模型输入尺寸时使用缩小解码，
+        libjpeg只需解码部分DCT系数，解码耗时随倍数下降；其他格式正常解码
+        """
+        if not image_bytes.startswith(b"\xff\xd8\xff"):
+            return cv2.IMREAD_COLOR
+        try:
+            # PIL打开时只解析文件头，不解码像素
+            width, height = Image.open(io.BytesIO(image_bytes)).size
+        except Exception:
+            return cv2.IMREAD_COLOR
 
-        # 归一化 (使用与训练时相同的均值和标准差)
-        mean = np.array([0.485, 0.456, 0.406], dtype=np.float32).reshape((1, 1, 3))
-        std = np.array([0.229, 0.224, 0.225], dtype=np.float32).reshape((1, 1, 3))
-        img_array = ((img_array / 255.0 - mean) / std).astype(np.float32)
+        scale = min(width / self.input_size[0], height / self.input_size[1])
+        for factor, flag in self._JPEG_REDUCED_FLAGS:
+            if scale >= factor:
+                return flag
+        return cv2.IMREAD_COLOR
 
-        # 调整维度顺序 (HWC -> NCHW)
-        img_array = img_array.transpose((2, 0, 1)).reshape(1, 3, *self.input_size)
+    def preprocess_into(self, image_bytes: bytes, out: np.ndarray):
+        """将图像预处理后直接写入out((3, H, W)的float32数组)，不产生中间浮点数组"""
+        # 读取图像，OpenCV解码为BGR格式；大尺寸JPEG直接在DCT域按1/2、1/4、1/8缩小解码
+        image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), self._imread_flags(image_bytes))
+        if image is None:
+            # OpenCV无法解码的格式(如GIF)交给PIL处理
+            image = cv2.cvtColor(np.asarray(Image.open(io.BytesIO(image_bytes)).convert('RGB')), cv2.COLOR_RGB2BGR)
 
-        return img_array
+        # 调整大小
+        image = cv2.resize(image, self.input_size, interpolation=cv2.INTER_AREA)
+
+        # HWC->CHW和BGR->RGB都只是视图，减均值时直接写入out，再原地乘以缩放系数
+        np.subtract(image.transpose((2, 0, 1))[::-1], self.MEAN, out=out)
+        out *= self.SCALE
 
     def predict(self, image_bytes: bytes) -> Dict[str, Any]:
         """预测图像是否为DORO表情包"""
-        try:
-            start_time = time.time()
+        return self.predict_batch([image_bytes])[0]
 
-            # 预处理图像
-            input_data = self.preprocess_image(image_bytes)
+    def predict_batch(
+            self,
+            image_bytes_list: List[bytes],
+            input_buffer: Optional[np.ndarray] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        批量预测，所有能正常预处理的图像合并为一次推理
 
-            # 运行推理
-            results = self.session.run([self.output_name], {self.input_name: input_data})
-            output = results[0]
+        每张图像预处理后直接写入批次数组的对应位置，无需逐张分配再拼接；
+        input_buffer为可复用的(N, 3, H, W)缓冲区，未传入时按本批大小分配
+        """
+        start_time = time.time()
 
-            # 获取概率
-            probabilities = self.softmax(output[0])
+        if input_buffer is None or len(input_buffer) < len(image_bytes_list):
+            input_buffer = np.empty((len(image_bytes_list), 3, *self.input_size), dtype=np.float32)
+        input_data = input_buffer
+        indices = []
+        results: List[Optional[Dict[str, Any]]] = [None] * len(image_bytes_list)
+        for i, image_bytes in enumerate(image_bytes_list):
+            try:
+                self.preprocess_into(image_bytes, input_data[len(indices)])
+                indices.append(i)
+            except Exception as e:
+                logger.error(f"DORO分类预测错误: {e}")
+                results[i] = self._error_result(e)
 
-            # 获取预测类别和置信度
-            predicted_class = np.argmax(probabilities)
-            confidence = float(probabilities[predicted_class])
+        if indices:
+            try:
+                probabilities = self._run_batch(input_data[:len(indices)])
+                inference_time = time.time() - start_time
+                for i, result in zip(indices, self._build_results(probabilities, inference_time)):
+                    results[i] = result
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("DORO分类器推理完成，批大小: %d，耗时: %.4f秒", len(indices), inference_time)
+            except Exception as e:
+                logger.error(f"DORO分类预测错误: {e}")
+                for i in indices:
+                    results[i] = self._error_result(e)
+
+        return results
+
+    def _run_batch(self, input_data: np.ndarray) -> np.ndarray:
+        """对(N, 3, H, W)的输入执行推理，超过最大批大小时分段执行，返回逐行softmax后的概率"""
+        if len(input_data) <= self.max_batch_size:
+            output = self._infer(input_data)
+        else:
+            output = np.concatenate([
+                self._infer(input_data[i:i + self.max_batch_size])
+                for i in range(0, len(input_data), self.max_batch_size)
+            ], axis=0)
+        return self.softmax(output)
 
-            # 假设索引0对应DORO类别
-            is_doro = predicted_class == 0
+    def _infer(self, input_data: np.ndarray) -> np.ndarray:
+        """
+        通过IOBinding执行一次推理
 
-            inference_time = time.time() - start_time
-            logger.debug(f"DORO分类器推理完成，耗时: {inference_time:.4f}秒")
+        CPU上直接引用numpy内存作为输入，省去run()内部的一次拷贝；
+        每次调用单独创建绑定，多个线程可以同时推理
+        """
+        io_binding = self.session.io_binding()
+        io_binding.bind_cpu_input(self.input_name, np.ascontiguousarray(input_data))
+        io_binding.bind_output(self.output_name, self.device)
+        self.session.run_with_iobinding(io_binding)
+        return io_binding.copy_outputs_to_cpu()[0]
+
+    @staticmethod
+    def _build_results(probabilities: np.ndarray, inference_time: float) -> List[Dict[str, Any]]:
+        """根据(N, 类别数)的概率构造每张图像的预测结果，类别和置信度整批一次计算"""
+        # 获取预测类别和置信度
+        predicted_classes = probabilities.argmax(axis=-1)
+        confidences = np.take_along_axis(probabilities, predicted_classes[:, None], axis=-1)[:, 0]
+        inference_time_ms = int(inference_time * 1000)
 
-            return {
-                "is_doro": is_doro,
+        results = []
+        for predicted_class, confidence, row in zip(
+                predicted_classes.tolist(), confidences.tolist(), probabilities.tolist()
+        ):
+            results.append({
+                # 假设索引0对应DORO类别
+                "is_doro": predicted_class == 0,
                 "confidence": confidence,
                 "probabilities": {
-                    "doro": float(probabilities[0]),
-                    "non_doro": float(probabilities[1]) if len(probabilities) > 1 else 0.0
+                    "doro": row[0],
+                    "non_doro": row[1] if len(row) > 1 else 0.0
                 },
-                "inference_time_ms": int(inference_time * 1000)
+                "inference_time_ms": inference_time_ms
+            })
+        return results
+
+    @staticmethod
+    def _error_result(error: Exception) -> Dict[str, Any]:
+        """预测失败时返回的结果"""
+        return {
+            "is_doro": False,
+            "confidence": 0.0,
+            "error": str(error),
+            "probabilities": {
+                "doro": 0.0,
+                "non_doro": 0.0
             }
+        }
+
+    def start_batcher(self):
+        """启动动态批处理后台任务，需在事件循环中调用"""
+        if self.max_batch_size <= 1 or self._batch_task is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._batch_buffers = tuple(
+            np.empty((self.max_batch_size, 3, *self.input_size), dtype=np.float32) for _ in range(2)
+        )
+        self._preprocess_pool = ThreadPoolExecutor(
+            max_workers=_CPUS_PER_WORKER, thread_name_prefix="doro-preprocess"
+        )
+        self._batch_task = asyncio.create_task(self._batch_loop())
+        logger.info(f"DORO分类器动态批处理已启动，最大批大小: {self.max_batch_size}")
+
+    async def stop_batcher(self):
+        """停止动态批处理后台任务"""
+        if self._batch_task is None:
+            return
+        for task in (self._batch_task, self._inference_task):
+            if task is None:
+                continue
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._batch_task = None
+        self._inference_task = None
+
+        # 队列中未处理的请求直接返回失败
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_result(self._error_result(RuntimeError("分类器已停止")))
+        self._queue = None
+        self._batch_buffers = None
+        self._preprocess_pool.shutdown(wait=False)
+        self._preprocess_pool = None
+
+    async def predict_async(self, image_bytes: bytes) -> Dict[str, Any]:
+        """
+        异步预测接口
+
+        图像放入队列，由后台任务将并发的请求合并为一次预处理和推理；
+        批处理未启动时退回到线程池中单张推理
+        """
+        if self._batch_task is None:
+            return await asyncio.to_thread(self.predict, image_bytes)
+
+        start_time = time.time()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((image_bytes, future))
+        result = await future
+        if "error" not in result:
+            result["inference_time_ms"] = int((time.time() - start_time) * 1000)
+        return result
+
+    async def _collect_batch(self, batch: List[Tuple[bytes, asyncio.Future]]):
+        """等待第一个请求，之后在最长等待时间内尽量凑满一个批次"""
+        batch.append(await self._queue.get())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_batch_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+    async def _batch_loop(self):
+        """
+        后台批处理循环
+
+        每批图像在线程池中并行预处理，写入两个缓冲区中空闲的一个；推理作为单独的任务执行，
+        推理期间继续收集和预处理下一批，形成流水线，同一时间只有一个批次在推理
+        """
+        loop = asyncio.get_running_loop()
+        slot = 0
+        batch = []
+        try:
+            while True:
+                batch = []
+                await self._collect_batch(batch)
+                input_buffer = self._batch_buffers[slot]
+
+                # 并行预处理，每张图像写入缓冲区的对应行
+                outcomes = await asyncio.gather(*[
+                    loop.run_in_executor(self._preprocess_pool, self.preprocess_into, image_bytes, input_buffer[i])
+                    for i, (image_bytes, _) in enumerate(batch)
+                ], return_exceptions=True)
+
+                # 预处理失败的请求直接返回错误，成功的行前移，保持连续
+                valid = []
+                for i, ((_, future), outcome) in enumerate(zip(batch, outcomes)):
+                    if isinstance(outcome, Exception):
+                        logger.error(f"DORO分类预测错误: {outcome}")
+                        if not future.done():
+                            future.set_result(self._error_result(outcome))
+                    else:
+                        valid.append(i)
+                if not valid:
+                    continue
+                if len(valid) < len(batch):
+                    input_buffer[:len(valid)] = input_buffer[valid]
 
+                # 等待上一批推理完成后再开始本批，上一批使用的是另一个缓冲区
+                if self._inference_task is not None:
+                    await asyncio.shield(self._inference_task)
+                futures = [batch[i][1] for i in valid]
+                batch = []
+                # 只有真正送去推理的批次才切换缓冲区；整批预处理失败时下一批继续写入同一个缓冲区，
+                # 不会写入仍在推理中的另一个缓冲区
+                slot ^= 1
+                self._inference_task = asyncio.create_task(
+                    self._infer_and_resolve(input_buffer[:len(futures)], futures)
+                )
+        except asyncio.CancelledError:
+            # 停止时已取出但尚未完成的请求直接返回失败，避免调用方一直等待
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(self._error_result(RuntimeError("分类器已停止")))
+            raise
+
+    async def _infer_and_resolve(self, input_data: np.ndarray, futures: List[asyncio.Future]):
+        """对一批已预处理的输入执行推理，并设置各请求的结果"""
+        try:
+            probabilities = await asyncio.to_thread(self._run_batch, input_data)
+            results = self._build_results(probabilities, 0.0)
+        except asyncio.CancelledError:
+            results = [self._error_result(RuntimeError("分类器已停止")) for _ in futures]
+            raise
         except Exception as e:
-            logger.error(f"DORO分类预测错误: {e}")
-            return {
-                "is_doro": False,
-                "confidence": 0.0,
-                "error": str(e),
-                "probabilities": {
-                    "doro": 0.0,
-                    "non_doro": 0.0
-                }
-            }
+            logger.error(f"DORO分类批量推理错误: {e}")
+            results = [self._error_result(e) for _ in futures]
+        finally:
+            for future, result in zip(futures, results):
+                if not future.done():
+                    future.set_result(result)
 
     @staticmethod
     def softmax(x: np.ndarray) -> np.ndarray:
-        """计算softmax"""
-        e_x = np.exp(x - np.max(x))
-        return e_x / e_x.sum()
+        """沿最后一维原地计算softmax(会覆盖x)，支持单条和批量输出"""
+        x -= x.max(axis=-1, keepdims=True)
+        np.exp(x, out=x)
+        x /= x.sum(axis=-1, keepdims=True)
+        return x
 
 
 # 创建单例实例
@@ -1,10 +1,9 @@
 import hashlib
-import os
-import tempfile
-import uuid
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 from app.config import settings
 
@@ -15,36 +14,38 @@ class ImageUploadService:
         self.album_id = album_id
         self.upload_url = upload_url
 
+        # 复用同一个会话，连接保持长连接，避免每次上传都重新进行TCP/TLS握手
+        self.http = requests.Session()
+        self.http.headers.update({"X-API-Key": self.api_key})
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=64,
+            max_retries=Retry(total=3, backoff_factor=0.2)
+        )
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+
     def calculate_md5(self, image_bytes: bytes) -> str:
         """计算图像的MD5哈希值"""
         return hashlib.md5(image_bytes).hexdigest()
 
-    def upload_image(self, image_bytes: bytes) -> Dict[str, Any]:
-        """上传图像到图床服务并返回结果"""
-        try:
-            # 创建临时文件
-            temp_file_path = os.path.join(tempfile.gettempdir(), f"{uuid.uuid4()}.png")
-
-            # 保存图像到临时文件
-            with open(temp_file_path, "wb") as f:
-                f.write(image_bytes)
+    def upload_image(self, image_bytes: bytes, md5_hash: Optional[str] = None) -> Dict[str, Any]:
+        """上传图像到图床服务并返回结果，md5_hash为调用方已计算好的MD5"""
+        # MD5只计算一次，成功和失败的返回都复用
+        if md5_hash is None:
+            md5_hash = self.calculate_md5(image_bytes)
 
-            # 上传图像
-            with open(temp_file_path, "rb") as f:
-                files = {"source": f}
-                data = {"album_id": self.album_id}
-                headers = {"X-API-Key": self.api_key}
-
-                response = requests.post(
-                    self.upload_url,
-                    files=files,
-                    data=data,
-                    headers=headers
-                )
+        try:
+            # 直接以内存中的字节构造multipart请求，无需写入临时文件
+            files = {"source": ("upload.png", image_bytes, "image/png")}
+            data = {"album_id": self.album_id}
 
-            # 删除临时文件
-            if os.path.exists(temp_file_path):
-                os.remove(temp_file_path)
+            response = self.http.post(
+                self.upload_url,
+                files=files,
+                data=data,
+                timeout=settings.PICB_TIMEOUT
+            )
 
             # 解析响应
             if response.status_code == 200:
@@ -66,7 +67,7 @@ class ImageUploadService:
             return {
                 "success": False,
                 "error": f"上传失败: {response.status_code} - {response.text}",
-                "md5": self.calculate_md5(image_bytes),
+                "md5": md5_hash,
                 "url": ""
             }
 
@@ -74,7 +75,7 @@ class ImageUploadService:
             return {
                 "success": False,
                 "error": f"上传过程中出错: {str(e)}",
-                "md5": self.calculate_md5(image_bytes),
+                "md5": md5_hash,
                 "url": ""
             }
 
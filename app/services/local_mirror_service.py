@@ -0,0 +1,78 @@
+import contextlib
+import logging
+import os
+import queue
+import threading
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class LocalMirrorWriter:
+    """
+    本地图片副本的后台写入器
+
+    写入和删除请求放入队列后立即返回，由单独的后台线程按提交顺序执行，
+    上传和删除请求不再等待磁盘操作；同一文件先写后删的顺序也得以保证
+    """
+
+    def __init__(self):
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        """首次提交时启动后台线程"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="local-mirror-writer", daemon=True)
+                self._thread.start()
+
+    def write(self, file_path: str, data: bytes):
+        """提交一次写入，立即返回"""
+        self._ensure_started()
+        self._queue.put((file_path, data))
+
+    def remove(self, file_paths: List[str]):
+        """提交一批删除，文件不存在时忽略，立即返回"""
+        if file_paths:
+            self._ensure_started()
+            self._queue.put((file_paths, None))
+
+    def _run(self):
+        """后台线程：依次处理队列中的写入和删除请求，收到None时退出"""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            target, data = item
+            if data is None:
+                self._unlink(target)
+                continue
+            try:
+                with open(target, "wb") as f:
+                    f.write(data)
+            except Exception as e:
+                logger.error(f"保存图片到本地失败: {target} - {str(e)}")
+
+    @staticmethod
+    def _unlink(file_paths: List[str]):
+        """逐个删除文件，直接unlink并忽略不存在的文件，不再先stat判断"""
+        for file_path in file_paths:
+            try:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(file_path)
+            except OSError as e:
+                logger.error(f"删除本地图片失败: {file_path} - {str(e)}")
+
+    def close(self, timeout: Optional[float] = None):
+        """等待队列中已提交的写入和删除完成后停止后台线程"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread.is_alive():
+            self._queue.put(None)
+            thread.join(timeout)
+
+
+# 创建单例实例
+local_mirror_writer = LocalMirrorWriter()
@@ -1,30 +1,71 @@
 import base64
-from typing import Tuple
+import io
+import json
+import logging
+from typing import Any, Dict, Optional, Tuple
 
-from openai import OpenAI
+import httpx
+import orjson
+from PIL import Image
+from openai import AsyncOpenAI
 
 from app.config import settings
+from app.services.cache_service import cache_service
+
+logger = logging.getLogger(__name__)
+
+# 复用的JSON解码器，用于从模型回复的任意位置解析JSON对象
+_JSON_DECODER = json.JSONDecoder()
 
 
 class OCRService:
     def __init__(self):
-        self.openai_client = OpenAI(
+        # 异步客户端，等待模型返回时不阻塞事件循环；HTTP/2连接在请求之间复用
+        self.openai_client = AsyncOpenAI(
             api_key=settings.OPENAI_API_KEY,
-            base_url=settings.OPENAI_BASE_URL
+            base_url=settings.OPENAI_BASE_URL,
+            timeout=settings.OPENAI_TIMEOUT,
+            http_client=httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=32, max_keepalive_connections=32)
+            )
         )
 
-    def detect_text(self, image_bytes: bytes) -> Tuple[bool, str]:
+    # 发送给视觉模型的图片最长边，识别十来个字不需要更高的分辨率
+    OCR_MAX_SIZE = (512, 512)
+    OCR_JPEG_QUALITY = 80
+
+    def _encode_image(self, image_bytes: bytes) -> str:
+        """
+        将图像缩小并重新编码为JPEG后转换为base64，同一张图发起多个请求时只需编码一次
+
+        原图可能是几MB的PNG，缩小后请求体和图片token都大幅减少
+        """
+        try:
+            image = Image.open(io.BytesIO(image_bytes))
+            image.thumbnail(self.OCR_MAX_SIZE, Image.BILINEAR)
+            if image.mode in ("RGBA", "LA", "P"):
+                # 透明背景铺白底，避免转换为RGB后变成黑色、遮住深色文字
+                image = image.convert("RGBA")
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+            buffer = io.BytesIO()
+            image.convert("RGB").save(buffer, "JPEG", quality=self.OCR_JPEG_QUALITY)
+            return base64.b64encode(buffer.getvalue()).decode('utf-8')
+        except Exception as e:
+            logger.warning("图片压缩失败，使用原图: %s", e)
+            return base64.b64encode(image_bytes).decode('utf-8')
+
+    async def detect_text(self, image_bytes: bytes) -> Tuple[bool, str]:
         """使用AI检测图像中的文本"""
-        return self._ai_ocr_text(image_bytes)
+        return await self._ai_ocr_text(self._encode_image(image_bytes))
 
-    def _ai_ocr_text(self, image_bytes: bytes) -> Tuple[bool, str]:
+    async def _ai_ocr_text(self, image_base64: str) -> Tuple[bool, str]:
         """使用AI进行OCR文本检测"""
         try:
-            # 将图像转换为base64
-            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-
             # 调用API检测文本
-            response = self.openai_client.chat.completions.create(
+            response = await self.openai_client.chat.completions.create(
                 model="Pro/Qwen/Qwen2.5-VL-7B-Instruct",
                 messages=[
                     {
@@ -33,7 +74,7 @@ class OCRService:
                             {
                                 "type": "image_url",
                                 "image_url": {
-                                    "url": f"data:image/png;base64,{image_base64}"
+                                    "url": f"data:image/jpeg;base64,{image_base64}"
                                 }
                             },
                             {
@@ -47,31 +88,32 @@ class OCRService:
             )
 
             text = response.choices[0].message.content.strip()
-            print(f'AI OCR返回: {text}')
+            logger.debug("AI OCR返回: %s", text)
             has_text = text != "无文字" and len(text) > 0
 
             return has_text, text if has_text else ""
 
-        except Exception as e:
-            print(f"AI OCR错误: {str(e)}")
+        except Exception:
+            logger.exception("AI OCR错误")
             return False, ""
 
-    def generate_description(self, image_bytes: bytes) -> str:
+    async def generate_description(self, image_bytes: bytes) -> str:
         """为表情包生成描述"""
+        return await self._describe_or_default(self._encode_image(image_bytes))
+
+    async def _describe_or_default(self, image_base64: str) -> str:
+        """生成描述，出错时返回默认描述"""
         try:
-            return self._ai_describe_image(image_bytes)
-        except Exception as e:
-            print(f"描述生成错误: {str(e)}")
+            return await self._ai_describe_image(image_base64)
+        except Exception:
+            logger.exception("描述生成错误")
             return "野生的doro表情包"
 
-    def _ai_describe_image(self, image_bytes: bytes) -> str:
+    async def _ai_describe_image(self, image_base64: str) -> str:
         """使用AI生成图像描述"""
         try:
-            # 将图像转换为base64
-            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-
             # 调用API生成描述
-            response = self.openai_client.chat.completions.create(
+            response = await self.openai_client.chat.completions.create(
                 model="Pro/Qwen/Qwen2.5-VL-7B-Instruct",
                 messages=[
                     {
@@ -80,7 +122,7 @@ class OCRService:
                             {
                                 "type": "image_url",
                                 "image_url": {
-                                    "url": f"data:image/png;base64,{image_base64}"
+                                    "url": f"data:image/jpeg;base64,{image_base64}"
                                 }
                             },
                             {
@@ -102,89 +144,127 @@ class OCRService:
 
             return description if description else "野生的doro表情包"
 
-        except Exception as e:
-            print(f"AI描述错误: {str(e)}")
+        except Exception:
+            logger.exception("AI描述错误")
             return "野生的doro表情包"
 
-    def generate_description_with_text_detection(self, image_bytes: bytes) -> Tuple[str, bool, bool]:
+    async def generate_description_with_text_detection(
+            self,
+            image_bytes: bytes,
+            md5_hash: Optional[str] = None
+    ) -> Tuple[str, bool, bool]:
         """
         使用AI一次性生成描述并检测是否有文字，同时进行内容安全检测
 
+        传入md5_hash时按图片MD5缓存结果，同一张图再次上传无需重新调用模型
         返回: (描述, 是否有文字, 是否安全)
         """
+        cache_key = f"ocr:{md5_hash}" if md5_hash else None
+        if cache_key:
+            cached = await cache_service.get(cache_key)
+            if cached is not None:
+                return tuple(cached)
+
         try:
-            # 转换为base64
-            import base64
-            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+            result = await self._describe_with_text_detection(image_bytes)
+        except Exception:
+            logger.exception("生成描述时出错")
+            return "野生的doro表情包", False, False
 
-            # 调用OpenAI API生成描述、检测文字和安全性
-            response = self.openai_client.chat.completions.create(
-                model="Pro/Qwen/Qwen2.5-VL-7B-Instruct",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/png;base64,{image_base64}"
-                                }
-                            },
-                            {
-                                "type": "text",
-                                "text": "请分析这个表情包的以下内容：\n1. 提取表情包中的文字内容（不超过10个字）\n2. 判断表情包中是否包含可识别的文字\n3. 评估表情包内容是否安全（是否包含血腥、暴力、色情等不友好内容，以及是否包含AI生成的字眼）\n\n请回复JSON格式，包含三个字段：\n- \"description\": 表情包文本内容，不超过10个字\n- \"has_text\": 布尔值，表示表情包中是否包含可识别的文字\n- \"is_safe\": 布尔值，表示表情包内容是否安全（不包含血腥、暴力、色情、AI生成等不良内容）"
+        # 只缓存模型正常返回的结果，出错时下次重新请求
+        if cache_key:
+            await cache_service.set(cache_key, list(result), settings.OCR_CACHE_TTL)
+        return result
+
+    @staticmethod
+    def _extract_json(reply_text: str) -> Optional[Dict[str, Any]]:
+        """
+        从模型回复中提取JSON对象
+
+        先按整段JSON解析，失败时从每个"{"开始用raw_decode尝试解析，
+        可以处理Markdown代码块和前后的说明文字，不会像贪婪正则那样回溯
+        """
+        try:
+            data = orjson.loads(reply_text)
+            if isinstance(data, dict):
+                return data
+        except orjson.JSONDecodeError:
+            pass
+
+        start = reply_text.find("{")
+        while start != -1:
+            try:
+                data, _ = _JSON_DECODER.raw_decode(reply_text, start)
+                if isinstance(data, dict):
+                    return data
+            except ValueError:
+                pass
+            start = reply_text.find("{", start + 1)
+        return None
+
+    async def _describe_with_text_detection(self, image_bytes: bytes) -> Tuple[str, bool, bool]:
+        """调用模型生成描述、检测文字和安全性，请求失败时抛出异常"""
+        # 转换为base64
+        image_base64 = self._encode_image(image_bytes)
+
+        # 调用OpenAI API生成描述、检测文字和安全性
+        response = await self.openai_client.chat.completions.create(
+            model="Pro/Qwen/Qwen2.5-VL-7B-Instruct",
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:image/jpeg;base64,{image_base64}"
                             }
-                        ]
-                    }
-                ],
-                max_tokens=150
-            )
+                        },
+                        {
+                            "type": "text",
+                            "text": "请分析这个表情包的以下内容：\n1. 提取表情包中的文字内容（不超过10个字）\n2. 判断表情包中是否包含可识别的文字\n3. 评估表情包内容是否安全（是否包含血腥、暴力、色情等不友好内容，以及是否包含AI生成的字眼）\n\n请回复JSON格式，包含三个字段：\n- \"description\": 表情包文本内容，不超过10个字\n- \"has_text\": 布尔值，表示表情包中是否包含可识别的文字\n- \"is_safe\": 布尔值，表示表情包内容是否安全（不包含血腥、暴力、色情、AI生成等不良内容）"
+                        }
+                    ]
+                }
+            ],
+            max_tokens=150
+        )
 
-            # 解析回复
-            import json
-            import re
-
-            # 获取回复内容并尝试提取JSON
-            reply_text = response.choices[0].message.content.strip()
-
-            # 使用正则表达式从回复中提取JSON部分
-            json_match = re.search(r'({.*})', reply_text, re.DOTALL)
-            if json_match:
-                try:
-                    json_data = json.loads(json_match.group(1))
-                    description = json_data.get("description", "野生的doro表情包")
-                    has_text = json_data.get("has_text", False)
-                    is_safe = json_data.get("is_safe", False)  # 新增安全检测字段
-                except json.JSONDecodeError:
-                    # 如果JSON解析失败，使用默认值
-                    description = "野生的doro表情包"
-                    has_text = False
-                    is_safe = False
-            else:
-                # 如果没有找到JSON格式，直接使用回复作为描述
-                description = reply_text[:10] if len(reply_text) > 10 else reply_text
-                has_text = "文字" in reply_text or "字" in reply_text
-                # 通过关键词判断安全性
-                unsafe_keywords = ['血腥', '暴力', '色情', '不友好', '不安全', 'AI生成', 'AI', '生成']
-                is_safe = not any(keyword in reply_text for keyword in unsafe_keywords)
-
-            # 确保描述不为空
-            if not description or description.strip() == "" or description == "无":
-                description = "野生的doro表情包"
-
-            # 限制描述长度
-            if len(description) > 10:
-                description = description[:10]
+        # 获取回复内容并尝试提取JSON
+        reply_text = response.choices[0].message.content.strip()
 
-            # 如果内容不安全，返回特定的描述
-            if not is_safe:
-                description = "内容不安全的doro表情包"
+        # 从回复中提取JSON部分
+        json_data = self._extract_json(reply_text)
+        if json_data is not None:
+            description = json_data.get("description", "野生的doro表情包")
+            has_text = json_data.get("has_text", False)
+            is_safe = json_data.get("is_safe", False)  # 新增安全检测字段
+        elif "{" in reply_text:
+            # 如果JSON解析失败，使用默认值
+            description = "野生的doro表情包"
+            has_text = False
+            is_safe = False
+        else:
+            # 如果没有找到JSON格式，直接使用回复作为描述
+            description = reply_text[:10] if len(reply_text) > 10 else reply_text
+            has_text = "文字" in reply_text or "字" in reply_text
+            # 通过关键词判断安全性
+            unsafe_keywords = ['血腥', '暴力', '色情', '不友好', '不安全', 'AI生成', 'AI', '生成']
+            is_safe = not any(keyword in reply_text for keyword in unsafe_keywords)
 
-            return description, has_text, is_safe
+        # 确保描述不为空
+        if not description or description.strip() == "" or description == "无":
+            description = "野生的doro表情包"
 
-        except Exception as e:
-            print(f"生成描述时出错: {str(e)}")
-            return "野生的doro表情包", False, False
+        # 限制描述长度
+        if len(description) > 10:
+            description = description[:10]
+
+        # 如果内容不安全，返回特定的描述
+        if not is_safe:
+            description = "内容不安全的doro表情包"
+
+        return description, has_text, is_safe
 
 
 # 创建单例实例
@@ -1,64 +1,335 @@
+import asyncio
+import base64
 import hashlib
+import json
 import logging
 import os
+import threading
 import time
-from typing import List, Dict, Any, Optional, Tuple
-
-from sqlalchemy import desc
+from typing import List, Dict, Any, Literal, Optional, Tuple
+from urllib.parse import urlsplit
+
+import cv2
+import numpy as np
+import orjson
+from cachetools import TTLCache
+from sqlalchemy import and_, bindparam, cast, delete, desc, event, exists, tuple_, func, insert, select, text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, load_only, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 
 from app.config import settings
 from app.db.database import transaction_context
 from app.models.operation_log import OperationLog
-from app.models.sticker import Sticker
+from app.models.sticker import Sticker, STICKER_LIST_COLUMNS
 from app.models.tag import Tag, sticker_tags_association_table
 from app.models.user_action import UserAction
 from app.schemas.sticker import StickerUpdate
+from app.services.cache_service import cache_service
 from app.services.doro_classifier import doro_classifier
 from app.services.image_upload_service import image_upload_service
+from app.services.local_mirror_service import local_mirror_writer
 from app.services.ocr_service import ocr_service
 
 logger = logging.getLogger(__name__)
 
+# 未过滤时的总数缓存，避免每次列表请求都执行COUNT(*)
+_count_cache = TTLCache(maxsize=8, ttl=30)
+_count_cache_lock = threading.Lock()
+
+# 热门标签缓存，按(数量, 排序方式)缓存30秒，标签变化时清空
+_popular_tags_cache = TTLCache(maxsize=32, ttl=30)
+_popular_tags_cache_lock = threading.Lock()
+
+# 列表页缓存，按查询参数缓存不含用户操作的列表数据，表情包有任何变化时失效。
+# 配置了Redis时缓存在Redis中，各worker共享，键中带有版本号，写入提交后递增版本号，旧版本的页不再被读取；
+# 未配置Redis时缓存在进程内，提交后清空，其他worker无从得知，因此只在单worker部署时启用
+_LIST_PAGE_TTL = 10
+_LIST_PAGE_VERSION_KEY = "stickers:list_version"
+_LOCAL_LIST_PAGE_CACHE_ENABLED = settings.WORKERS <= 1
+_list_page_cache = TTLCache(maxsize=256, ttl=_LIST_PAGE_TTL)
+_list_page_cache_lock = threading.Lock()
+
+# 表的估算行数超过该值时直接使用统计信息中的估算值，不再精确COUNT(*)
+_ESTIMATED_COUNT_THRESHOLD = 100_000
+
+
+def _encode_cursor(sort_by: str, sort_order: str, sort_value: int, sticker_id: str) -> str:
+    """将排序方式和上一页最后一条记录的(排序值, ID)编码为游标"""
+    raw = json.dumps([sort_by, sort_order, sort_value, sticker_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str, sort_by: str, sort_order: str) -> Tuple[int, str]:
+    """
+    解析游标并校验，返回(排序值, ID)
+
+    可排序的列都是整数，排序值必须为整数、ID必须为字符串，否则数据库比较时才会出错；
+    游标只能用于生成它时的排序方式，换了排序字段或方向时拒绝
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        cursor_sort_by, cursor_sort_order, sort_value, sticker_id = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError) as e:
+        raise ValueError("无效的分页游标") from e
+    if type(sort_value) is not int or not isinstance(sticker_id, str):
+        raise ValueError("无效的分页游标")
+    if (cursor_sort_by, cursor_sort_order) != (sort_by, sort_order):
+        raise ValueError("分页游标与当前的排序方式不一致")
+    return sort_value, sticker_id
+
+
+# 热点查询在模块加载时构造一次，调用时只传入参数，省去每次构造语句和生成缓存键的开销
+_SELECT_STICKER_BY_MD5 = select(Sticker).where(Sticker.md5 == bindparam("md5"))
+_SELECT_STICKER_BY_PHASH = select(Sticker).where(Sticker.phash == bindparam("phash")).limit(1)
+_SELECT_USER_ACTION = select(UserAction.action).where(
+    UserAction.sticker_id == bindparam("sticker_id"),
+    UserAction.ip_address == bindparam("ip_address")
+)
+# 删除表情包时按ID或MD5查询删除本地文件需要的列
+_DELETE_LOOKUPS = {
+    "id": select(Sticker.id, Sticker.md5, Sticker.ext).where(Sticker.id == bindparam("identifier")),
+    "md5": select(Sticker.id, Sticker.md5, Sticker.ext).where(Sticker.md5 == bindparam("identifier")),
+}
+_LOCK_STICKER = select(Sticker.id).where(Sticker.id == bindparam("sticker_id")).with_for_update(key_share=True)
+
+# 投票：删除并返回已有操作；与本次操作不同时(包括原来没有操作)插入本次操作，相同时即为取消；
+# 两个数据修改CTE随计数UPDATE在同一条语句中执行，计数差值由CTE的结果算出
+_VOTE_PREVIOUS = (
+    delete(UserAction)
+    .where(UserAction.sticker_id == bindparam("sticker_id"), UserAction.ip_address == bindparam("ip_address"))
+    .returning(UserAction.action)
+    .cte("previous_action")
+)
+_VOTE_INSERTED = (
+    insert(UserAction)
+    .from_select(
+        ["sticker_id", "ip_address", "action"],
+        select(
+            bindparam("sticker_id"),
+            bindparam("ip_address"),
+            cast(bindparam("action"), UserAction.action.type)
+        ).where(~exists().where(_VOTE_PREVIOUS.c.action == bindparam("action")))
+    )
+    .returning(UserAction.action)
+    .cte("inserted_action")
+)
+
+
+def _vote_delta(action: str):
+    """本次投票对某一计数的变化：插入的操作加1，删除的操作减1"""
+    inserted = select(func.count()).where(_VOTE_INSERTED.c.action == action).scalar_subquery()
+    removed = select(func.count()).where(_VOTE_PREVIOUS.c.action == action).scalar_subquery()
+    return inserted - removed
+
+
+_VOTE_UPDATE = (
+    update(Sticker)
+    .where(Sticker.id == bindparam("sticker_id"))
+    .values(
+        likes=func.greatest(Sticker.likes + _vote_delta("like"), 0),
+        dislikes=func.greatest(Sticker.dislikes + _vote_delta("dislike"), 0)
+    )
+    .returning(Sticker, select(_VOTE_PREVIOUS.c.action).scalar_subquery())
+)
+
+
+def _invalidate_sticker_lists(db: Session):
+    """
+    表情包新增、删除或内容、计数、标签变化时，标记在当前事务提交后清空列表页缓存
+
+    提交前就清空的话，其间的列表请求会从只读会话读到提交前的数据并重新缓存
+    """
+    db.info["invalidate_sticker_lists"] = True
+
+
+def _invalidate_popular_tags(db: Session):
+    """标签或使用计数变化时，标记在当前事务提交后清空热门标签缓存"""
+    db.info["invalidate_popular_tags"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _clear_caches_after_commit(db: Session):
+    """事务提交后清空事务中标记过的缓存"""
+    if db.info.pop("invalidate_sticker_lists", False):
+        cache_service.incr_sync(_LIST_PAGE_VERSION_KEY)
+        with _list_page_cache_lock:
+            _list_page_cache.clear()
+    if db.info.pop("invalidate_popular_tags", False):
+        with _popular_tags_cache_lock:
+            _popular_tags_cache.clear()
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_cache_marks(db: Session):
+    """事务回滚时数据没有变化，丢弃缓存清空标记"""
+    db.info.pop("invalidate_sticker_lists", None)
+    db.info.pop("invalidate_popular_tags", None)
+
+
+async def _get_list_page(cache_key: tuple) -> Tuple[Optional[list], Optional[str]]:
+    """
+    读取缓存的列表页，返回(缓存的(列表, 总数, 下一页游标), 共享缓存键)，未命中或缓存未启用时前者为None
+
+    共享缓存键在查询数据库之前按当前版本号生成，查询期间有写入提交时，结果写入的是已失效的旧版本
+    """
+    if cache_service.redis is not None:
+        version = await cache_service.get(_LIST_PAGE_VERSION_KEY) or 0
+        shared_key = f"stickers:list:{version}:{hashlib.md5(orjson.dumps(cache_key)).hexdigest()}"
+        return await cache_service.get(shared_key), shared_key
+    if _LOCAL_LIST_PAGE_CACHE_ENABLED:
+        with _list_page_cache_lock:
+            return _list_page_cache.get(cache_key), None
+    return None, None
+
+
+async def _set_list_page(cache_key: tuple, shared_key: Optional[str], page: list):
+    """缓存列表页，shared_key为_get_list_page返回的共享缓存键"""
+    if shared_key is not None:
+        await cache_service.set(shared_key, page, _LIST_PAGE_TTL)
+    elif _LOCAL_LIST_PAGE_CACHE_ENABLED:
+        with _list_page_cache_lock:
+            _list_page_cache[cache_key] = page
+
+
+def _tagged_sticker_ids(tags: List[str], match_all: bool):
+    """
+    构造按标签筛选表情包ID的子查询，作为IN条件使用
+
+    match_all为True时要求包含全部指定标签：按表情包分组，命中的不同标签数等于指定标签数；
+    否则包含任意一个即可：IN条件由数据库按半连接执行，无需DISTINCT去重后再连接
+    """
+    tag_names = set(tags)
+    query = (
+        select(sticker_tags_association_table.c.sticker_id)
+        .join(Tag, Tag.id == sticker_tags_association_table.c.tag_id)
+        .where(Tag.name.in_(tag_names))
+    )
+    if match_all:
+        query = (
+            query.group_by(sticker_tags_association_table.c.sticker_id)
+            .having(func.count(func.distinct(Tag.id)) == len(tag_names))
+        )
+    return query
+
+
+def _description_matches(search_query: str):
+    """
+    描述模糊匹配条件，转义用户输入中的LIKE通配符
+
+    描述上的三元组索引根据搜索词中的字符提取三元组；未转义的%和_会把搜索词拆碎，
+    提取不到三元组时只能扫描全部索引或全表，同时也会匹配到不含这些字符的描述
+    """
+    escaped = search_query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return Sticker.description.ilike(f"%{escaped}%", escape="\\")
+
+
+def _url_extension(url: str) -> str:
+    """从图床URL中解析文件后缀，忽略查询参数"""
+    return os.path.splitext(urlsplit(url).path)[1][1:]
+
+
+def _perceptual_hash(image_bytes: bytes) -> Optional[int]:
+    """
+    计算图片的64位感知哈希(pHash)，以有符号64位整数返回，无法解码时返回None
+
+    灰度图缩放到32x32后做DCT，取左上角8x8的低频系数与其中位数比较得到64位，
+    重新编码、缩放、轻微压缩过的同一张图得到相同的哈希
+    """
+    try:
+        gray = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            return None
+        gray = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+        low = cv2.dct(gray)[:8, :8]
+        bits = np.packbits(low > np.median(low))
+        return int.from_bytes(bits.tobytes(), "big", signed=True)
+    except Exception as e:
+        logger.warning("计算感知哈希失败: %s", e)
+        return None
+
 
 class StickerService:
-    def create_sticker(
+    async def count_stickers(self, db: AsyncSession) -> int:
+        """
+        获取表情包总数，结果在进程内缓存30秒
+
+        表较大时使用pg_class中的估算行数(O(1))，否则精确计数
+        """
+        with _count_cache_lock:
+            total = _count_cache.get("stickers")
+        if total is None:
+            # 从未ANALYZE过的表reltuples为-1，此时同样退回到精确计数
+            total = await db.scalar(
+                text("SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:table AS regclass)"),
+                {"table": Sticker.__tablename__}
+            )
+            if total is None or total < _ESTIMATED_COUNT_THRESHOLD:
+                # 单独构造的计数查询，不带ORDER BY和多余的列
+                total = await db.scalar(select(func.count()).select_from(Sticker))
+            with _count_cache_lock:
+                _count_cache["stickers"] = total
+        return total
+
+    async def create_sticker(
             self,
             db: Session,
             image_bytes: bytes,
             ip_address: str,
-            user_agent: Optional[str] = None
+            user_agent: Optional[str] = None,
+            md5_hash: Optional[str] = None
     ) -> Dict[str, Any]:
-        """创建表情包记录，包含完整的处理流程"""
+        """
+        创建表情包记录，包含完整的处理流程，md5_hash为调用方已计算好的MD5
+
+        AI描述请求和DORO分类直接在事件循环中等待，数据库和图床上传等阻塞操作放到线程池中执行；
+        DORO分类与MD5查重、AI描述同时进行；图床是公开的，内容安全检查通过前不上传，因此上传仍在两项检查之后
+        """
         try:
-            # 1: 计算MD5
-            md5_hash = hashlib.md5(image_bytes).hexdigest()
-            logger.debug(f"MD5: {md5_hash}")
+            # 1: 计算MD5(调用方在读取上传数据时已计算的直接复用)
+            if md5_hash is None:
+                md5_hash = hashlib.md5(image_bytes).hexdigest()
+            logger.debug("MD5: %s", md5_hash)
+
+            # 2: DORO分类在本地完成，与MD5查重同时开始，并发的上传请求由分类器合并为一批推理，
+            # 结果按MD5缓存，被拒绝后重复上传的图片直接使用上次的结果
+            doro_task = asyncio.create_task(self._classify(image_bytes, md5_hash))
+            ocr_task = None
+            try:
+                # 3: 检查MD5(开启PHASH_DEDUP时还有感知哈希)是否已存在，已存在时取消分类
+                existing_sticker, phash = await asyncio.to_thread(self._find_duplicate, db, md5_hash, image_bytes)
+                if existing_sticker:
+                    return {
+                        "success": False,
+                        "message": "表情包已存在",
+                        "sticker": existing_sticker
+                    }
 
-            # 2: 检查MD5是否已存在
-            existing_sticker = db.query(Sticker).filter(Sticker.md5 == md5_hash).first()
-            if existing_sticker:
-                return {
-                    "success": False,
-                    "message": "表情包已存在",
-                    "sticker": existing_sticker.as_dict()
-                }
+                # 4: 不重复时才发起AI描述请求（同时检测是否有文字和内容安全），与分类同时进行，
+                # 不是DORO表情包时取消尚未完成的AI请求
+                ocr_task = asyncio.create_task(
+                    ocr_service.generate_description_with_text_detection(image_bytes, md5_hash)
+                )
 
-            # 3: 使用DORO分类器检查是否为DORO表情包
-            doro_result = doro_classifier.predict(image_bytes)
-            logger.debug(f"DORO分类结果: {doro_result}")
+                # 使用DORO分类器检查是否为DORO表情包
+                doro_result = await doro_task
+                logger.debug("DORO分类结果: %s", doro_result)
 
-            if not doro_result["is_doro"] or doro_result["confidence"] < 0.6:
-                return {
-                    "success": False,
-                    "message": "上传的图片不是DORO表情包，或DORO可能性较低",
-                    "details": doro_result
-                }
+                if not doro_result["is_doro"] or doro_result["confidence"] < 0.6:
+                    return {
+                        "success": False,
+                        "message": "上传的图片不是DORO表情包，或DORO可能性较低",
+                        "details": doro_result
+                    }
 
-            # 4: 使用AI直接生成描述（同时检测是否有文字和内容安全）
-            description, has_text, is_safe = ocr_service.generate_description_with_text_detection(image_bytes)
-            logger.debug(f"OCR识别结果: 描述={description}, 有文字={has_text}, 是否安全={is_safe}")
+                description, has_text, is_safe = await ocr_task
+            finally:
+                doro_task.cancel()
+                if ocr_task is not None:
+                    ocr_task.cancel()
+            logger.debug("OCR识别结果: 描述=%s, 有文字=%s, 是否安全=%s", description, has_text, is_safe)
 
             # 5: 检查内容安全性
             if not is_safe:
@@ -69,8 +340,8 @@ class StickerService:
                 }
 
             # 6: 上传到图床
-            upload_result = image_upload_service.upload_image(image_bytes)
-            logger.debug(f"图片上传结果: {upload_result}")
+            upload_result = await asyncio.to_thread(image_upload_service.upload_image, image_bytes, md5_hash)
+            logger.debug("图片上传结果: %s", upload_result)
 
             if not upload_result["success"]:
                 return {
@@ -81,82 +352,182 @@ class StickerService:
 
             # 6: 保存一份MD5+原后缀到本地PIC_DIR目录下
             if settings.PIC_DIR and settings.PIC_DIR != "":
-                try:
-                    # 获取文件后缀
-                    file_extension = upload_result["url"].split(".")[-1]
-                    file_path = os.path.join(settings.PIC_DIR, f"{md5_hash}.{file_extension}")
-
-                    # 保存文件
-                    with open(file_path, "wb") as f:
-                        f.write(image_bytes)
-                except Exception as e:
-                    logger.error(f"保存图片到本地失败: {str(e)}")
+                self._save_local_copy(image_bytes, md5_hash, upload_result["url"])
 
             # 7: 创建数据库记录
-            with transaction_context(db) as tx:
-                # 创建Sticker对象
-                db_sticker = Sticker(
-                    md5=upload_result["md5"],
-                    url=upload_result["url"],
-                    description=description,
-                    doro_confidence=float(doro_result["confidence"]),
-                    width=upload_result.get("width"),
-                    height=upload_result.get("height"),
-                    file_size=upload_result.get("size")
-                )
-
-                # 保存到数据库
-                tx.add(db_sticker)
-                tx.flush()  # 确保可以获取ID
-
-                # 标签处理逻辑
-                if has_text:
-                    # 获取或创建"有文字"标签
-                    text_tag = tx.query(Tag).filter(Tag.name == "有文字").first()
-                    if not text_tag:
-                        text_tag = Tag(name="有文字", usage_count=0)
-                        tx.add(text_tag)
-                        tx.flush()  # 确保可以获取新标签的ID
-                    # text_tag = tx.merge(Tag(name="有文字", usage_count=0))
-
-                    # 建立关联关系
-                    db_sticker.tags.append(text_tag)
-
-                    # 更新使用计数
-                    text_tag.usage_count += 1
-
-                # 记录操作日志
-                operation_log = OperationLog(
-                    ip_address=ip_address,
-                    user_agent=user_agent,
-                    sticker_id=db_sticker.id,
-                    operation='upload',
-                    new_description=description,
-                    operation_time=int(time.time())
-                )
-                tx.add(operation_log)
-
+            sticker = await asyncio.to_thread(
+                self._insert_sticker,
+                db, upload_result, description, doro_result, has_text, phash, ip_address, user_agent
+            )
+            if sticker is None:
+                # 查重之后同一张图被并发上传并先一步写入
                 return {
-                    "success": True,
-                    "message": "表情包上传成功",
-                    "sticker": db_sticker.as_dict()
+                    "success": False,
+                    "message": "表情包已存在",
+                    "sticker": await asyncio.to_thread(self._get_sticker_dict_by_md5, db, upload_result["md5"])
                 }
+            return {
+                "success": True,
+                "message": "表情包上传成功",
+                "sticker": sticker
+            }
 
         except SQLAlchemyError as e:
-            logger.error(f"数据库操作错误: {str(e)}")
+            logger.error("数据库操作错误: %s", e)
             return {
                 "success": False,
                 "message": f"数据库操作失败: {str(e)}",
                 "details": {"error_type": "database_error"}
             }
         except Exception as e:
-            logger.error(f"处理表情包时出错: {str(e)}")
+            logger.error("处理表情包时出错: %s", e)
             return {
                 "success": False,
                 "message": f"处理表情包失败: {str(e)}",
                 "details": {"error_type": "processing_error"}
             }
 
+    @staticmethod
+    async def _classify(image_bytes: bytes, md5_hash: str) -> Dict[str, Any]:
+        """DORO分类，按图片MD5缓存分类结果，推理出错时不缓存"""
+        cache_key = f"doro:{md5_hash}"
+        cached = await cache_service.get(cache_key)
+        if cached is not None:
+            return cached
+
+        result = await doro_classifier.predict_async(image_bytes)
+        if "error" not in result:
+            await cache_service.set(cache_key, result, settings.DORO_CACHE_TTL)
+        return result
+
+    def _find_duplicate(
+            self,
+            db: Session,
+            md5: str,
+            image_bytes: bytes
+    ) -> Tuple[Optional[Dict[str, Any]], Optional[int]]:
+        """
+        查找已存在的相同表情包，返回(已存在的表情包字典, 图片的感知哈希)，供线程池中调用
+
+        先按MD5精确查找；未找到时计算感知哈希，开启PHASH_DEDUP时再按感知哈希查找，
+        命中时跳过分类、AI描述和图床上传。感知哈希随新记录一起保存
+        """
+        sticker = self.get_sticker_by_md5(db, md5)
+        if sticker:
+            return sticker.as_dict(), None
+
+        phash = _perceptual_hash(image_bytes)
+        if phash is not None and settings.PHASH_DEDUP:
+            sticker = db.execute(_SELECT_STICKER_BY_PHASH, {"phash": phash}).scalar_one_or_none()
+            if sticker:
+                return sticker.as_dict(), phash
+        return None, phash
+
+    def _get_sticker_dict_by_md5(self, db: Session, md5: str) -> Optional[Dict[str, Any]]:
+        """通过MD5查询表情包，返回字典形式，供线程池中调用"""
+        sticker = self.get_sticker_by_md5(db, md5)
+        return sticker.as_dict() if sticker else None
+
+    @staticmethod
+    def _save_local_copy(image_bytes: bytes, md5_hash: str, url: str):
+        """保存一份MD5+原后缀的图片到本地PIC_DIR目录下，由后台线程写入，不等待落盘"""
+        # 获取文件后缀
+        file_extension = _url_extension(url)
+        file_path = os.path.join(settings.PIC_DIR, f"{md5_hash}.{file_extension}")
+
+        # 保存文件
+        local_mirror_writer.write(file_path, image_bytes)
+
+    @staticmethod
+    def _bump_tags(tx: Session, tag_deltas: Dict[str, int]) -> Dict[str, Tag]:
+        """
+        按名称批量获取标签并将各自的使用计数加上对应的增量(结果不低于0)，
+        不存在的标签以增量为初始计数创建，返回名称到标签的映射
+
+        使用INSERT ... ON CONFLICT DO UPDATE ... RETURNING，一条语句完成查询、创建和计数，
+        并发创建同名标签时也不会因唯一约束冲突而失败
+        """
+        if not tag_deltas:
+            return {}
+        _invalidate_popular_tags(tx)
+
+        # 按名称排序后插入，并发事务以相同顺序锁定标签行，避免死锁
+        now = int(time.time())
+        stmt = pg_insert(Tag).values([
+            {"name": name, "usage_count": tag_deltas[name], "created_at": now, "updated_at": now}
+            for name in sorted(tag_deltas)
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Tag.name],
+            set_={"usage_count": func.greatest(Tag.usage_count + stmt.excluded.usage_count, 0), "updated_at": now}
+        ).returning(Tag)
+        return {
+            tag.name: tag
+            for tag in tx.scalars(stmt, execution_options={"populate_existing": True})
+        }
+
+    @staticmethod
+    def _insert_sticker(
+            db: Session,
+            upload_result: Dict[str, Any],
+            description: str,
+            doro_result: Dict[str, Any],
+            has_text: bool,
+            phash: Optional[int],
+            ip_address: str,
+            user_agent: Optional[str]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        在一个事务中写入表情包、标签关联和操作日志，返回表情包字典
+
+        以INSERT ... ON CONFLICT (md5) DO NOTHING RETURNING写入，同一张图并发上传时
+        后到的请求不会因唯一约束报错，而是返回None，由调用方按已存在处理
+        """
+        with transaction_context(db) as tx:
+            db_sticker = tx.scalars(
+                pg_insert(Sticker)
+                .values(
+                    md5=upload_result["md5"],
+                    url=upload_result["url"],
+                    description=description,
+                    doro_confidence=float(doro_result["confidence"]),
+                    width=upload_result.get("width"),
+                    height=upload_result.get("height"),
+                    file_size=upload_result.get("size"),
+                    ext=_url_extension(upload_result["url"]),
+                    phash=phash
+                )
+                .on_conflict_do_nothing(index_elements=[Sticker.md5])
+                .returning(Sticker)
+            ).first()
+            if db_sticker is None:
+                return None
+            _invalidate_sticker_lists(tx)
+
+            # 新记录没有标签，直接设为空集合，避免as_dict访问tags时再查询一次刚插入的记录
+            set_committed_value(db_sticker, "tags", [])
+
+            # 标签处理逻辑
+            if has_text:
+                # 获取或创建"有文字"标签，同时更新使用计数
+                text_tag = StickerService._bump_tags(tx, {"有文字": 1})["有文字"]
+
+                # 建立关联关系
+                db_sticker.tags.append(text_tag)
+
+            # 记录操作日志
+            operation_log = OperationLog(
+                ip_address=ip_address,
+                user_agent=user_agent,
+                sticker_id=db_sticker.id,
+                operation='upload',
+                new_description=description,
+                operation_time=int(time.time())
+            )
+            tx.add(operation_log)
+
+            return db_sticker.as_dict()
+
     def get_stickers(
             self,
             db: Session,
@@ -174,19 +545,16 @@ class StickerService:
             if sort_by not in allowed_sort_fields:
                 sort_by = "created_at"
 
-            query = db.query(Sticker)
+            # 标签在一次IN查询中批量加载，序列化时不再逐个表情包懒加载
+            query = db.query(Sticker).options(load_only(*STICKER_LIST_COLUMNS), selectinload(Sticker.tags))
 
             # 应用搜索条件
             if search_query:
-                query = query.filter(Sticker.description.ilike(f"%{search_query}%"))
+                query = query.filter(_description_matches(search_query))
 
-            # 应用标签过滤
+            # 应用标签过滤，要求包含全部指定标签
             if tags:
-                for tag in tags:
-                    query = query.filter(Sticker.tags.contains([tag]))
-
-            # 计算总数
-            total = query.count()
+                query = query.filter(Sticker.id.in_(_tagged_sticker_ids(tags, match_all=True)))
 
             # 应用排序
             if sort_order.lower() == "desc":
@@ -194,27 +562,45 @@ class StickerService:
             else:
                 query = query.order_by(getattr(Sticker, sort_by))
 
-            # 应用分页
-            stickers = query.offset(skip).limit(limit).all()
+            # 应用分页，总数通过窗口函数随分页数据一并返回，不再单独执行COUNT查询
+            rows = query.add_columns(func.count().over()).offset(skip).limit(limit).all()
+            stickers = [sticker for sticker, _ in rows]
+            if rows:
+                total = rows[0][1]
+            else:
+                # 页码超出范围时拿不到窗口计数，此时才单独计数
+                total = query.order_by(None).count() if skip else 0
 
             return stickers, total
         except SQLAlchemyError as e:
-            logger.error(f"获取表情包列表时发生数据库错误: {e}")
+            logger.error("获取表情包列表时发生数据库错误: %s", e)
             raise
         except Exception as e:
-            logger.error(f"获取表情包列表时发生错误: {e}")
+            logger.error("获取表情包列表时发生错误: %s", e)
             raise
 
     def get_sticker(self, db: Session, sticker_id: str) -> Optional[Sticker]:
         """根据ID获取表情包"""
-        return db.query(Sticker).filter(Sticker.id == sticker_id).first()
+        # 按主键查询，会话中已加载过该表情包时直接返回，不再访问数据库
+        return db.get(Sticker, sticker_id)
+
+    def get_random_stickers(self, db: Session, count: int = 1) -> List[Dict[str, Any]]:
+        """随机获取表情包"""
+        stickers = db.query(Sticker).options(selectinload(Sticker.tags)).order_by(func.random()).limit(count).all()
+        return [sticker.as_dict() for sticker in stickers]
 
     def get_popular_tags(
             self, db: Session,
             limit: int = 10,
             sort_order: str = "desc"
     ) -> List[Dict[str, Any]]:
-        """获取热门标签"""
+        """获取热门标签，结果在进程内缓存30秒"""
+        cache_key = (limit, sort_order.lower())
+        with _popular_tags_cache_lock:
+            cached = _popular_tags_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
         try:
             # 基本查询与原来的get_stickers相同
             query = db.query(Tag.name, Tag.usage_count)
@@ -234,9 +620,11 @@ class StickerService:
                     "count": tag.usage_count
                 })
 
+            with _popular_tags_cache_lock:
+                _popular_tags_cache[cache_key] = result
             return result
-        except Exception as e:
-            print(f"获取热门标签时出错: {str(e)}")
+        except Exception:
+            logger.exception("获取热门标签时出错")
             return []
 
     def add_tag_to_sticker(self, db: Session, sticker_id: int, tag_name: str) -> Dict[str, Any]:
@@ -244,23 +632,16 @@ class StickerService:
         try:
             with transaction_context(db) as tx:
                 # 获取表情包
-                db_sticker = tx.query(Sticker).filter(Sticker.id == sticker_id).first()
+                db_sticker = tx.get(Sticker, sticker_id)
                 if not db_sticker:
                     return {"success": False, "message": "表情包不存在"}
 
-                # 获取或创建标签
-                text_tag = tx.query(Tag).filter(Tag.name == tag_name).first()
-                if not text_tag:
-                    text_tag = Tag(name=tag_name, usage_count=0)
-                    tx.add(text_tag)
-                    tx.flush()  # 确保可以获取新标签的ID
-                # text_tag = tx.merge(Tag(name=tag_name, usage_count=0))
+                # 获取或创建标签，同时更新使用计数
+                text_tag = self._bump_tags(tx, {tag_name: 1})[tag_name]
 
                 # 建立关联关系
                 db_sticker.tags.append(text_tag)
-
-                # 更新使用计数
-                text_tag.usage_count += 1
+                _invalidate_sticker_lists(tx)
 
                 return {
                     "success": True,
@@ -269,10 +650,10 @@ class StickerService:
                     "action": "tag"
                 }
         except SQLAlchemyError as e:
-            logger.error(f"创建标签时发生数据库错误: {e}")
+            logger.error("创建标签时发生数据库错误: %s", e)
             return {"success": False, "message": f"数据库操作失败: {str(e)}"}
         except Exception as e:
-            logger.error(f"创建标签时发生错误: {e}")
+            logger.error("创建标签时发生错误: %s", e)
             return {"success": False, "message": f"操作失败: {str(e)}"}
 
     def update_tags_to_sticker(self, db: Session, sticker_id: int, tags: list[str]) -> Dict[str, Any]:
@@ -280,24 +661,28 @@ class StickerService:
         try:
             with transaction_context(db) as tx:
                 # 获取表情包
-                db_sticker = tx.query(Sticker).filter(Sticker.id == sticker_id).first()
+                db_sticker = tx.get(Sticker, sticker_id)
                 if not db_sticker:
                     return {"success": False, "message": "表情包不存在"}
 
-                # 清除现有标签
-                db_sticker.tags.clear()
-
-                # 遍历标签列表，获取或创建标签
-                for tag_name in tags:
-                    # 获取或创建标签
-                    text_tag = tx.query(Tag).filter(Tag.name == tag_name).first()
-                    if not text_tag:
-                        text_tag = Tag(name=tag_name, usage_count=0)
-                        tx.add(text_tag)
-                        tx.flush()  # 确保可以获取新标签的ID
-
-                    # 更新关联关系
-                    db_sticker.tags.append(text_tag)
+                # 新增的标签使用计数加1，移除的减1，保留的不变，一条语句完成获取、创建和计数
+                tag_names = list(dict.fromkeys(tags))
+                old_names = {tag.name for tag in db_sticker.tags}
+                tag_deltas = {name: 0 if name in old_names else 1 for name in tag_names}
+                tag_deltas.update((name, -1) for name in old_names.difference(tag_names))
+                tags_by_name = self._bump_tags(tx, tag_deltas)
+
+                # 整体替换现有标签，只增删有变化的关联
+                db_sticker.tags = [tags_by_name[name] for name in tag_names]
+                _invalidate_sticker_lists(tx)
+
+                # 与删除表情包时一致，计数降到0的标签一并删除(先flush删除关联，再删除标签)
+                unused_tag_ids = [
+                    tag.id for name, tag in tags_by_name.items() if tag_deltas[name] < 0 and tag.usage_count <= 0
+                ]
+                if unused_tag_ids:
+                    tx.flush()
+                    self._delete_unused_tags(tx, unused_tag_ids)
 
                 return {
                     "success": True,
@@ -306,15 +691,15 @@ class StickerService:
                     "action": "tag"
                 }
         except SQLAlchemyError as e:
-            logger.error(f"更新标签时发生数据库错误: {e}")
+            logger.error("更新标签时发生数据库错误: %s", e)
             return {"success": False, "message": f"数据库操作失败: {str(e)}"}
         except Exception as e:
-            logger.error(f"更新标签时发生错误: {e}")
+            logger.error("更新标签时发生错误: %s", e)
             return {"success": False, "message": f"操作失败: {str(e)}"}
 
     def get_sticker_by_md5(self, db: Session, md5: str) -> Optional[Sticker]:
         """根据MD5获取表情包"""
-        return db.query(Sticker).filter(Sticker.md5 == md5).first()
+        return db.execute(_SELECT_STICKER_BY_MD5, {"md5": md5}).scalar_one_or_none()
 
     def update_sticker(self, db: Session, sticker_id: int, sticker_update: StickerUpdate) -> Optional[Sticker]:
         """更新表情包信息"""
@@ -328,220 +713,206 @@ class StickerService:
             setattr(db_sticker, key, value)
 
         # 保存到数据库
+        _invalidate_sticker_lists(db)
         db.commit()
         db.refresh(db_sticker)
         return db_sticker
 
     def get_user_action(self, db: Session, sticker_id: int, ip_address: str) -> Optional[str]:
         """获取用户对表情包的操作（like/dislike）"""
-        action = db.query(UserAction).filter(
-            UserAction.sticker_id == sticker_id,
-            UserAction.ip_address == ip_address
-        ).first()
-
-        return action.action if action else None
+        return db.execute(
+            _SELECT_USER_ACTION, {"sticker_id": sticker_id, "ip_address": ip_address}
+        ).scalar_one_or_none()
+
+    # 点赞/点踩的提示信息: 操作 -> (取消, 从另一操作切换, 新增)
+    _VOTE_MESSAGES = {
+        "like": ("取消点赞成功", "从点踩切换为点赞成功", "点赞成功"),
+        "dislike": ("取消点踩成功", "从点赞切换为点踩成功", "点踩成功"),
+    }
+
+    def _vote_sticker(self, tx: Session, sticker_id: str, ip_address: str, action: str) -> Dict[str, Any]:
+        """
+        点赞/点踩的公共实现：重复操作为取消，相反操作为切换
+
+        先锁定表情包行，同一表情包的投票依次执行；之后操作记录的删除、插入和计数更新
+        在一条语句中完成，计数按差值原子更新，不再先读出再写回
+        """
+        # 计数更新本来就要获取该行的锁，提前获取不会降低并发度，还能保证同一IP的首次操作不会重复计数
+        locked = tx.execute(_LOCK_STICKER, {"sticker_id": sticker_id}).scalar_one_or_none()
+        if locked is None:
+            return {"success": False, "message": "表情包不存在"}
+
+        db_sticker, previous = tx.execute(
+            _VOTE_UPDATE,
+            {"sticker_id": sticker_id, "ip_address": ip_address, "action": action},
+            execution_options={"synchronize_session": False, "populate_existing": True}
+        ).one()
+        new_action = None if previous == action else action
+        _invalidate_sticker_lists(tx)
+
+        cancel_message, switch_message, new_message = self._VOTE_MESSAGES[action]
+        if new_action is None:
+            message = cancel_message
+        elif previous is not None:
+            message = switch_message
+        else:
+            message = new_message
+        return {
+            "success": True,
+            "message": message,
+            "sticker": db_sticker.as_dict(),
+            "action": new_action
+        }
 
     def like_sticker(self, db: Session, sticker_id: str, ip_address: str) -> Dict[str, Any]:
         """对表情包点赞，使用事务确保原子性"""
         try:
             with transaction_context(db) as tx:
-                db_sticker = tx.query(Sticker).filter(Sticker.id == sticker_id).first()
-                if not db_sticker:
-                    return {"success": False, "message": "表情包不存在"}
-
-                # 检查用户是否已对此表情包操作过
-                existing_action = tx.query(UserAction).filter(
-                    UserAction.sticker_id == sticker_id,
-                    UserAction.ip_address == ip_address
-                ).first()
-
-                if existing_action:
-                    if existing_action.action == 'like':
-                        # 如果已经点赞，则取消点赞
-                        db_sticker.likes = max(0, db_sticker.likes - 1)
-                        tx.delete(existing_action)
-                        return {
-                            "success": True,
-                            "message": "取消点赞成功",
-                            "sticker": db_sticker.as_dict(),
-                            "action": None
-                        }
-                    else:
-                        # 如果已经点踩，则切换为点赞
-                        db_sticker.dislikes = max(0, db_sticker.dislikes - 1)
-                        db_sticker.likes += 1
-                        existing_action.action = 'like'
-                        return {
-                            "success": True,
-                            "message": "从点踩切换为点赞成功",
-                            "sticker": db_sticker.as_dict(),
-                            "action": "like"
-                        }
-                else:
-                    # 新增点赞记录
-                    db_sticker.likes += 1
-                    new_action = UserAction(
-                        ip_address=ip_address,
-                        sticker_id=sticker_id,
-                        action='like'
-                    )
-                    tx.add(new_action)
-                    return {
-                        "success": True,
-                        "message": "点赞成功",
-                        "sticker": db_sticker.as_dict(),
-                        "action": "like"
-                    }
+                return self._vote_sticker(tx, sticker_id, ip_address, "like")
         except SQLAlchemyError as e:
-            logger.error(f"点赞操作数据库错误: {e}")
+            logger.error("点赞操作数据库错误: %s", e)
             return {"success": False, "message": f"数据库操作失败: {str(e)}"}
         except Exception as e:
-            logger.error(f"点赞操作错误: {e}")
+            logger.error("点赞操作错误: %s", e)
             return {"success": False, "message": f"操作失败: {str(e)}"}
 
     def dislike_sticker(self, db: Session, sticker_id: int, ip_address: str) -> Dict[str, Any]:
         """对表情包点踩"""
         try:
             with transaction_context(db) as tx:
-                db_sticker = tx.query(Sticker).filter(Sticker.id == sticker_id).first()
-                if not db_sticker:
-                    return {"success": False, "message": "表情包不存在"}
-
-                # 检查用户是否已对此表情包操作过
-                existing_action = tx.query(UserAction).filter(
-                    UserAction.sticker_id == sticker_id,
-                    UserAction.ip_address == ip_address
-                ).first()
-
-                if existing_action:
-                    if existing_action.action == 'dislike':
-                        # 如果已经点踩，则取消点踩
-                        db_sticker.dislikes = max(0, db_sticker.dislikes - 1)
-                        tx.delete(existing_action)
-                        return {
-                            "success": True,
-                            "message": "取消点踩成功",
-                            "sticker": db_sticker.as_dict(),
-                            "action": None
-                        }
-                    else:
-                        # 如果已经点赞，则切换为点踩
-                        db_sticker.likes = max(0, db_sticker.likes - 1)
-                        db_sticker.dislikes += 1
-                        existing_action.action = 'dislike'
-                        return {
-                            "success": True,
-                            "message": "从点赞切换为点踩成功",
-                            "sticker": db_sticker.as_dict(),
-                            "action": "dislike"
-                        }
-                else:
-                    # 新增点踩记录
-                    db_sticker.dislikes += 1
-                    new_action = UserAction(
-                        ip_address=ip_address,
-                        sticker_id=sticker_id,
-                        action='dislike'
-                    )
-                    tx.add(new_action)
-                    return {
-                        "success": True,
-                        "message": "点踩成功",
-                        "sticker": db_sticker.as_dict(),
-                        "action": "dislike"
-                    }
+                return self._vote_sticker(tx, sticker_id, ip_address, "dislike")
         except SQLAlchemyError as e:
-            logger.error(f"点踩操作数据库错误: {e}")
+            logger.error("点踩操作数据库错误: %s", e)
             return {"success": False, "message": f"数据库操作失败: {str(e)}"}
         except Exception as e:
-            logger.error(f"点踩操作错误: {e}")
+            logger.error("点踩操作错误: %s", e)
             return {"success": False, "message": f"操作失败: {str(e)}"}
 
-    def get_stickers_with_user_actions(
+    async def get_stickers_with_user_actions(
             self,
-            db: Session,
+            db: AsyncSession,
             ip_address: str,
             skip: int = 0,
             limit: int = 20,
             sort_by: str = "created_at",
             sort_order: str = "desc",
             search_query: Optional[str] = None,
-            tags: Optional[List[str]] = None
-    ) -> Tuple[List[Dict[str, Any]], int]:
-        """获取表情包列表，并包含当前用户的操作状态"""
+            tags: Optional[List[str]] = None,
+            after: Optional[str] = None
+    ) -> Tuple[List[Dict[str, Any]], Optional[int], Optional[str]]:
+        """
+        获取表情包列表，并包含当前用户的操作状态
+
+        传入after游标时使用键集分页(按(排序字段, id)做范围扫描)，忽略skip；
+        否则退回到传统的OFFSET分页。返回(列表, 总数, 下一页游标)，
+        带搜索或标签过滤时不统计总数，返回None，是否有下一页由游标判断
+        """
         # 使用安全的属性访问，防止SQL注入
         allowed_sort_fields = {"created_at", "likes", "dislikes"}
         if sort_by not in allowed_sort_fields:
             sort_by = "created_at"
-
-        # 基本查询与原来的get_stickers相同
-        query = db.query(Sticker)
+        sort_order = "desc" if sort_order.lower() == "desc" else "asc"
+
+        # 先校验游标，缓存命中时也不接受无效的游标
+        if after:
+            cursor_value, cursor_id = _decode_cursor(after, sort_by, sort_order)
+
+        # 列表数据与IP无关，命中缓存时只需按IP查询当前页的用户操作
+        cache_key = (skip, limit, sort_by, sort_order, search_query, tuple(tags) if tags else None, after)
+        cached, shared_key = await _get_list_page(cache_key)
+        if cached is not None:
+            items, total, next_cursor = cached
+            actions = {}
+            if items:
+                actions = dict((await db.execute(
+                    select(UserAction.sticker_id, UserAction.action).where(
+                        UserAction.sticker_id.in_([item["id"] for item in items]),
+                        UserAction.ip_address == ip_address
+                    )
+                )).all())
+            return [{**item, "user_action": actions.get(item["id"])} for item in items], total, next_cursor
+
+        # 异步会话不能懒加载，标签通过selectinload一次性批量加载；
+        # 当前用户的操作通过左连接与表情包一并查出，不再单独查询一次
+        query = (
+            select(Sticker, UserAction.action)
+            .outerjoin(
+                UserAction,
+                and_(UserAction.sticker_id == Sticker.id, UserAction.ip_address == ip_address)
+            )
+            .options(load_only(*STICKER_LIST_COLUMNS), selectinload(Sticker.tags))
+        )
 
         # 应用搜索条件
         if search_query:
-            query = query.filter(Sticker.description.ilike(f"%{search_query}%"))
+            query = query.where(_description_matches(search_query))
 
-        # 应用标签过滤
+        # 应用标签过滤，包含任意指定标签即可
         if tags:
-            # 创建子查询获取包含任意指定标签的sticker_id
-            subquery = (
-                db.query(sticker_tags_association_table.c.sticker_id)
-                .join(Tag, Tag.id == sticker_tags_association_table.c.tag_id)
-                .filter(Tag.name.in_(tags))
-                .distinct()  # 添加distinct避免重复
-            ).subquery()
+            query = query.where(Sticker.id.in_(_tagged_sticker_ids(tags, match_all=False)))
+
+        # 仅在未过滤时返回总数(走缓存)，过滤查询的COUNT代价过高
+        total = None if search_query or tags else await self.count_stickers(db)
 
-            query = query.join(subquery, Sticker.id == subquery.c.sticker_id)
+        # 以id作为第二排序键，保证排序稳定，游标才能唯一定位
+        sort_column = getattr(Sticker, sort_by)
+        descending = sort_order == "desc"
 
-        # 计算总数
-        total = query.count()
+        # 应用游标条件
+        if after:
+            row_key = tuple_(sort_column, Sticker.id)
+            if descending:
+                query = query.where(row_key < (cursor_value, cursor_id))
+            else:
+                query = query.where(row_key > (cursor_value, cursor_id))
 
         # 应用排序
-        if sort_order.lower() == "desc":
-            query = query.order_by(desc(getattr(Sticker, sort_by)))
+        if descending:
+            query = query.order_by(desc(sort_column), desc(Sticker.id))
         else:
-            query = query.order_by(getattr(Sticker, sort_by))
+            query = query.order_by(sort_column, Sticker.id)
 
-        # 应用分页
-        stickers = query.offset(skip).limit(limit).all()
+        # 应用分页，多取一条用于判断是否还有下一页
+        if not after:
+            query = query.offset(skip)
+        rows = (await db.execute(query.limit(limit + 1))).all()
 
-        # 获取用户操作
-        sticker_ids = [s.id for s in stickers]
-        user_actions = {}
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1][0]
+            next_cursor = _encode_cursor(sort_by, sort_order, getattr(last, sort_by), last.id)
 
-        if sticker_ids:
-            actions = db.query(UserAction).filter(
-                UserAction.sticker_id.in_(sticker_ids),
-                UserAction.ip_address == ip_address
-            ).all()
+        # 缓存不含用户操作的列表数据，返回时再合并用户操作
+        items = [sticker.as_dict(list_only=True) for sticker, _ in rows]
+        await _set_list_page(cache_key, shared_key, [items, total, next_cursor])
 
-            user_actions = {a.sticker_id: a.action for a in actions}
-
-        # 将用户操作合并到表情包数据中
-        result = []
-        for sticker in stickers:
-            sticker_dict = sticker.as_dict()
-            sticker_dict["user_action"] = user_actions.get(sticker.id)
-            result.append(sticker_dict)
-
-        return result, total
+        return [{**item, "user_action": action} for item, (_, action) in zip(items, rows)], total, next_cursor
 
     def batch_download_stickers(self, db: Session, sticker_ids: List[str]) -> List[Dict[str, Any]]:
-        """获取批量下载的表情包信息"""
-        stickers = db.query(Sticker).filter(Sticker.id.in_(sticker_ids)).all()
-        return [sticker.as_dict() for sticker in stickers]
+        """
+        获取批量下载的表情包信息，只查询下载需要的列，不构造ORM对象，也不加载标签
+
+        结果按请求中ID的顺序返回(重复的ID只保留一个)，不存在的ID直接跳过
+        """
+        rows = db.execute(
+            select(Sticker.id, Sticker.description, Sticker.md5, Sticker.url).where(Sticker.id.in_(sticker_ids))
+        ).mappings()
+        by_id = {row["id"]: dict(row) for row in rows}
+        return [by_id[sticker_id] for sticker_id in dict.fromkeys(sticker_ids) if sticker_id in by_id]
 
     def update_sticker_description(self, db: Session, sticker_id: int, description: str, ip_address: str,
                                    user_agent: Optional[str] = None) -> Dict[str, Any]:
         """更新表情包描述"""
         try:
             with transaction_context(db) as tx:
-                db_sticker = tx.query(Sticker).filter(Sticker.id == sticker_id).first()
+                db_sticker = tx.get(Sticker, sticker_id)
                 if not db_sticker:
                     return {"success": False, "message": "表情包不存在"}
 
                 old_description = db_sticker.description
                 db_sticker.description = description
+                _invalidate_sticker_lists(tx)
 
                 # 记录操作日志
                 operation_log = OperationLog(
@@ -562,91 +933,143 @@ class StickerService:
                 "action": "description"
             }
         except SQLAlchemyError as e:
-            logger.error(f"更新表情包描述时发生数据库错误: {e}")
+            logger.error("更新表情包描述时发生数据库错误: %s", e)
             return {"success": False, "message": f"数据库操作失败: {str(e)}"}
         except Exception as e:
-            logger.error(f"更新表情包描述时发生错误: {e}")
+            logger.error("更新表情包描述时发生错误: %s", e)
             return {"success": False, "message": f"操作失败: {str(e)}"}
 
-    def delete_sticker(self, db: Session, identifier: str) -> Dict[str, Any]:
-        """删除表情包"""
+    def delete_sticker(
+            self,
+            db: Session,
+            identifier: str,
+            identifier_type: Optional[Literal["id", "md5"]] = None
+    ) -> Dict[str, Any]:
+        """删除表情包，identifier_type指定identifier是ID还是MD5"""
         try:
-            if len(identifier) == 32:  # MD5长度校验
-                db_sticker = db.query(Sticker).filter(Sticker.md5 == identifier).first()
-            else:
-                db_sticker = db.query(Sticker).filter(Sticker.id == identifier).first()
+            # 只取删除本地文件需要的列；未指定标识类型时按长度判断(MD5为32位，ID为36位带连字符的UUID)
+            if identifier_type is None:
+                identifier_type = "md5" if len(identifier) == 32 else "id"
+            db_sticker = db.execute(_DELETE_LOOKUPS[identifier_type], {"identifier": identifier}).first()
 
             if not db_sticker:
                 return {"success": False, "message": "表情包不存在"}
 
-            # 删除本地文件
-            if settings.PIC_DIR:
-                file_extension = db_sticker.url.split(".")[-1]
-                file_path = os.path.join(settings.PIC_DIR, f"{db_sticker.md5}.{file_extension}")
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-
-            # 删除数据库记录
+            # 删除数据库记录，标签计数与批量删除一样在SQL中按分组扣减
             with transaction_context(db) as tx:
-                # 删除关联的标签
-                for tag in db_sticker.tags:
-                    tag.usage_count -= 1
-                    if tag.usage_count <= 0:
-                        tx.delete(tag)
+                self._delete_sticker_rows(tx, [db_sticker.id])
 
-                # 删除用户行为记录
-                tx.query(UserAction).filter(UserAction.sticker_id == db_sticker.id).delete()
-                # 删除表情包记录
-                tx.delete(db_sticker)
+            # 删除本地文件
+            if settings.PIC_DIR and db_sticker.ext:
+                local_mirror_writer.remove([os.path.join(settings.PIC_DIR, f"{db_sticker.md5}.{db_sticker.ext}")])
 
             return {
                 "success": True,
                 "message": "表情包删除成功"
             }
         except SQLAlchemyError as e:
-            logger.error(f"删除表情包时发生数据库错误: {e}")
+            logger.error("删除表情包时发生数据库错误: %s", e)
             return {"success": False, "message": f"数据库操作失败: {str(e)}"}
         except Exception as e:
-            logger.error(f"删除表情包时发生错误: {e}")
+            logger.error("删除表情包时发生错误: %s", e)
             return {"success": False, "message": f"操作失败: {str(e)}"}
 
+    def _delete_sticker_rows(self, tx: Session, sticker_ids: List[str]):
+        """删除表情包及其关联数据，语句数量与删除的表情包数量无关"""
+        # 扣减关联标签的使用计数
+        self._release_tags(tx, sticker_ids)
+        _invalidate_sticker_lists(tx)
+
+        # 删除用户行为记录、操作日志、标签关联和表情包记录
+        tx.execute(
+            delete(UserAction).where(UserAction.sticker_id.in_(sticker_ids)),
+            execution_options={"synchronize_session": False}
+        )
+        tx.execute(
+            delete(OperationLog).where(OperationLog.sticker_id.in_(sticker_ids)),
+            execution_options={"synchronize_session": False}
+        )
+        tx.execute(
+            delete(sticker_tags_association_table)
+            .where(sticker_tags_association_table.c.sticker_id.in_(sticker_ids))
+        )
+        tx.execute(
+            delete(Sticker).where(Sticker.id.in_(sticker_ids)),
+            execution_options={"synchronize_session": False}
+        )
+
+    @staticmethod
+    def _release_tags(tx: Session, sticker_ids: List[str]):
+        """
+        按待删除表情包关联的标签扣减使用计数，计数降到0及以下的标签一并删除
+
+        在一条UPDATE ... FROM中按标签分组扣减，不逐个加载表情包和标签
+        """
+        tag_counts = (
+            select(
+                sticker_tags_association_table.c.tag_id,
+                func.count().label("count")
+            )
+            .where(sticker_tags_association_table.c.sticker_id.in_(sticker_ids))
+            .group_by(sticker_tags_association_table.c.tag_id)
+            .subquery()
+        )
+        _invalidate_popular_tags(tx)
+        released = tx.execute(
+            update(Tag)
+            .where(Tag.id == tag_counts.c.tag_id)
+            .values(usage_count=Tag.usage_count - tag_counts.c.count)
+            .returning(Tag.id, Tag.usage_count),
+            execution_options={"synchronize_session": False}
+        ).all()
+
+        unused_tag_ids = [tag_id for tag_id, usage_count in released if usage_count <= 0]
+        if unused_tag_ids:
+            StickerService._delete_unused_tags(tx, unused_tag_ids, sticker_ids)
+
+    @staticmethod
+    def _delete_unused_tags(tx: Session, tag_ids: List[int], released_sticker_ids: Optional[List[str]] = None):
+        """
+        删除计数已降到0的标签，仍被其他表情包关联的标签保留
+
+        旧版本更新标签时不维护使用计数，计数可能低于实际关联数，只看计数会误删标签，
+        并经外键级联从其他表情包上移除；released_sticker_ids为即将删除关联的表情包，不算作使用
+        """
+        in_use = exists().where(sticker_tags_association_table.c.tag_id == Tag.id)
+        if released_sticker_ids:
+            in_use = in_use.where(sticker_tags_association_table.c.sticker_id.not_in(released_sticker_ids))
+        tx.execute(
+            delete(Tag).where(Tag.id.in_(tag_ids), ~in_use),
+            execution_options={"synchronize_session": False}
+        )
+
     def batch_delete_stickers(self, db: Session, sticker_ids: List[str]) -> Dict[str, Any]:
         """批量删除表情包"""
         try:
             if not sticker_ids:
                 return {"success": False, "message": "表情包ID列表不能为空"}
 
-            # 查询所有要删除的表情包
-            stickers = db.query(Sticker).filter(Sticker.id.in_(sticker_ids)).all()
+            # 查询所有要删除的表情包，只取删除本地文件需要的列
+            stickers = db.execute(
+                select(Sticker.id, Sticker.md5, Sticker.ext).where(Sticker.id.in_(sticker_ids))
+            ).all()
 
             if not stickers:
                 return {"success": False, "message": "未找到指定的表情包"}
 
-            found_ids = {sticker.id for sticker in stickers}
-            not_found_ids = set(sticker_ids) - found_ids
+            found_ids = [sticker.id for sticker in stickers]
+            not_found_ids = set(sticker_ids) - set(found_ids)
 
-            # 批量删除操作
+            # 批量删除操作，语句数量与删除的表情包数量无关
             with transaction_context(db) as tx:
-                for sticker in stickers:
-                    # 删除本地文件
-                    if settings.PIC_DIR:
-                        file_extension = sticker.url.split(".")[-1]
-                        file_path = os.path.join(settings.PIC_DIR, f"{sticker.md5}.{file_extension}")
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-
-                    # 删除关联的标签
-                    for tag in sticker.tags:
-                        tag.usage_count -= 1
-                        if tag.usage_count <= 0:
-                            tx.delete(tag)
-
-                    # 删除用户行为记录
-                    tx.query(UserAction).filter(UserAction.sticker_id == sticker.id).delete()
-                    # 删除操作日志记录
-                    tx.query(OperationLog).filter(OperationLog.sticker_id == sticker.id).delete()
-                    # 删除表情包记录
-                    tx.delete(sticker)
+                self._delete_sticker_rows(tx, found_ids)
+
+            # 删除本地文件
+            if settings.PIC_DIR:
+                local_mirror_writer.remove([
+                    os.path.join(settings.PIC_DIR, f"{sticker.md5}.{sticker.ext}")
+                    for sticker in stickers if sticker.ext
+                ])
 
             result_message = f"成功删除 {len(stickers)} 个表情包"
             if not_found_ids:
@@ -659,10 +1082,10 @@ class StickerService:
                 "not_found_ids": list(not_found_ids)
             }
         except SQLAlchemyError as e:
-            logger.error(f"批量删除表情包时发生数据库错误: {e}")
+            logger.error("批量删除表情包时发生数据库错误: %s", e)
             return {"success": False, "message": f"数据库操作失败: {str(e)}"}
         except Exception as e:
-            logger.error(f"批量删除表情包时发生错误: {e}")
+            logger.error("批量删除表情包时发生错误: %s", e)
             return {"success": False, "message": f"操作失败: {str(e)}"}
 
 
@@ -1,29 +1,44 @@
+import asyncio
+import atexit
 import logging
 import os
+import queue
 from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
 
+import httpx
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from app.api import stickers
 from app.config import settings
-from app.db.database import engine, Base
+from app.db.database import async_engine, init_db
 from app.middlewares.logging_middleware import LoggingMiddleware
+from app.services.cache_service import cache_service
+from app.services.doro_classifier import doro_classifier
+from app.services.local_mirror_service import local_mirror_writer
+
+# 配置日志：记录日志时只把日志放入队列，由后台线程格式化并输出，请求处理中不再等待终端或磁盘写入
+_log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_log_handlers = [
+    logging.StreamHandler(),
+    # logging.FileHandler("app.log")
+]
+for _handler in _log_handlers:
+    _handler.setFormatter(_log_formatter)
+
+# 入队前只合并消息参数，时间、级别等格式化由后台线程中的处理器完成
+_log_queue = queue.SimpleQueue()
+_queue_handler = QueueHandler(_log_queue)
+_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+log_listener = QueueListener(_log_queue, *_log_handlers, respect_handler_level=True)
+logging.basicConfig(level=logging.INFO, handlers=[_queue_handler])
+log_listener.start()
+# 进程退出时输出队列中剩余的日志；不在lifespan中停止，应用多次启停时日志也不会丢失
+atexit.register(log_listener.stop)
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        # logging.FileHandler("app.log")
-    ]
-)
 logger = logging.getLogger(__name__)
 
-# 创建数据库表
-Base.metadata.create_all(bind=engine)
-
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -31,9 +46,11 @@ async def lifespan(app: FastAPI):
     # 启动时执行
     logger.info("应用程序启动")
 
-    # 创建数据库表
-    logger.info("初始化数据库")
-    Base.metadata.create_all(bind=engine)
+    # 创建数据库表，只在应用启动时执行一次，导入模块时不再访问数据库；
+    # 由迁移工具管理表结构时可通过AUTO_CREATE_TABLES关闭
+    if settings.AUTO_CREATE_TABLES:
+        logger.info("初始化数据库")
+        init_db()
 
     # 确保临时目录存在
     os.makedirs(settings.TEMP_DIR, exist_ok=True)
@@ -41,9 +58,25 @@ async def lifespan(app: FastAPI):
     if settings.PIC_DIR and settings.PIC_DIR != "":
         os.makedirs(settings.PIC_DIR, exist_ok=True)
 
+    # 共享的HTTP客户端，连接池在请求之间复用，避免每次重新建立TCP/TLS连接
+    app.state.http_client = httpx.AsyncClient(
+        http2=True,
+        timeout=settings.HTTP_TIMEOUT,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=32)
+    )
+
+    # 合并并发的分类请求进行批量推理
+    doro_classifier.start_batcher()
+
     yield
 
     # 关闭时执行
+    await doro_classifier.stop_batcher()
+    await app.state.http_client.aclose()
+    await cache_service.close()
+    # 等待尚未落盘的本地图片副本写入完成
+    await asyncio.to_thread(local_mirror_writer.close)
+    await async_engine.dispose()
     logger.info("应用程序关闭")
 
 
@@ -71,9 +104,6 @@ app.add_middleware(LoggingMiddleware)
 # 包含路由
 app.include_router(stickers.router, prefix="/api/stickers", tags=["stickers"])
 
-# 确保临时目录存在
-os.makedirs(settings.TEMP_DIR, exist_ok=True)
-
 
 @app.get("/")
 def read_root():
@@ -95,5 +125,7 @@ if __name__ == '__main__':
         host=settings.HOST,
         port=settings.PORT,
         reload=settings.DEBUG,
-        workers=settings.WORKERS
+        workers=settings.WORKERS,
+        loop="uvloop",
+        http="httptools"
     )
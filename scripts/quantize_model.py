@@ -0,0 +1,65 @@
+"""
+离线生成DORO分类模型的量化版本
+
+依赖(服务运行时不需要，未放入requirements.txt):
+    pip install -r scripts/requirements.txt
+
+用法:
+    python scripts/quantize_model.py --int8            # 生成INT8模型(CPU推理)
+    python scripts/quantize_model.py --fp16            # 生成FP16模型(CUDA推理)
+    python scripts/quantize_model.py --int8 --fp16 -i model/model.onnx
+
+生成的文件路径默认取配置中的MODEL_PATH_INT8/MODEL_PATH_FP16，服务启动时会自动选用
+"""
+import argparse
+import logging
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.config import settings  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+def quantize_int8(input_path: str, output_path: str):
+    """动态量化为INT8，权重离线量化，激活值在推理时量化"""
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    quantize_dynamic(input_path, output_path, weight_type=QuantType.QInt8)
+    logger.info(f"INT8模型已生成: {output_path}")
+
+
+def convert_fp16(input_path: str, output_path: str):
+    """转换为FP16，保留FP32的输入输出，推理代码无需改动"""
+    import onnx
+    from onnxconverter_common import float16
+
+    model = onnx.load(input_path)
+    model_fp16 = float16.convert_float_to_float16(model, keep_io_types=True)
+    onnx.save(model_fp16, output_path)
+    logger.info(f"FP16模型已生成: {output_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成DORO分类模型的量化版本")
+    parser.add_argument("-i", "--input", default=settings.MODEL_PATH, help="原始FP32模型路径")
+    parser.add_argument("--int8", action="store_true", help="生成INT8动态量化模型")
+    parser.add_argument("--int8-output", default=settings.MODEL_PATH_INT8, help="INT8模型输出路径")
+    parser.add_argument("--fp16", action="store_true", help="生成FP16模型")
+    parser.add_argument("--fp16-output", default=settings.MODEL_PATH_FP16, help="FP16模型输出路径")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if not args.int8 and not args.fp16:
+        parser.error("至少指定--int8或--fp16之一")
+    if args.int8:
+        quantize_int8(args.input, args.int8_output)
+    if args.fp16:
+        convert_fp16(args.input, args.fp16_output)
+
+
+if __name__ == '__main__':
+    main()
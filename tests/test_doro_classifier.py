@@ -0,0 +1,51 @@
+import asyncio
+import io
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+try:
+    from app.services.doro_classifier import DoroClassifier
+except RuntimeError as e:
+    # 模块导入时会加载分类模型，本地没有模型文件时跳过
+    pytest.skip(f"无法加载DORO分类模型: {e}", allow_module_level=True)
+
+
+def _png(color) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def test_all_invalid_batch_does_not_overwrite_buffer_in_inference(monkeypatch):
+    """整批预处理失败后，下一批不能写入仍在推理中的缓冲区"""
+    monkeypatch.setattr(DoroClassifier, "_load_model", lambda self: None)
+    classifier = DoroClassifier(max_batch_size=2, max_batch_wait_ms=1)
+    unchanged = []
+
+    def slow_run_batch(input_data: np.ndarray) -> np.ndarray:
+        snapshot = input_data.copy()
+        time.sleep(0.3)
+        unchanged.append(np.array_equal(snapshot, input_data))
+        return np.tile(np.array([[0.9, 0.1]], dtype=np.float32), (len(input_data), 1))
+
+    classifier._run_batch = slow_run_batch
+
+    async def scenario():
+        classifier.start_batcher()
+        try:
+            first = asyncio.create_task(classifier.predict_async(_png((255, 0, 0))))
+            await asyncio.sleep(0.05)
+            invalid = await classifier.predict_async(b"not an image")
+            second = await classifier.predict_async(_png((0, 0, 255)))
+            return await first, invalid, second
+        finally:
+            await classifier.stop_batcher()
+
+    first, invalid, second = asyncio.run(scenario())
+
+    assert "error" in invalid
+    assert "error" not in first and "error" not in second
+    assert unchanged == [True, True]